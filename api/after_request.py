@@ -1,29 +1,127 @@
-from db import logs, stats, users
-from helpers import network
+"""Bookkeeping (token counting, logs and stats) for finished requests, done in the background so it doesn't delay responses."""
+
+import os
+import asyncio
+
+import provider_auth
+
+from db import logs, stats
+from helpers import tokens
+from request_context import RequestContext
+
+WORKERS = int(os.getenv('AFTER_REQUEST_WORKERS', '4'))
+QUEUE_SIZE = int(os.getenv('AFTER_REQUEST_QUEUE_SIZE', '10000'))
+
+class RequestRecord:
+    """Everything the bookkeeping needs to know about a finished request."""
+
+    __slots__ = ('user_id', 'ip_address', 'method', 'path', 'useragent', 'target_url', 'model', 'is_chat', 'input_tokens', 'messages', 'functions', 'provider_auth', 'timings')
+
+    def __init__(self, **kwargs):
+        for key in self.__slots__:
+            setattr(self, key, kwargs.get(key))
+
+queue = None
+workers = []
+
+async def start() -> None:
+    """Starts the workers which process the queued records."""
+
+    global queue
+
+    if workers:
+        return
+
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    for _ in range(WORKERS):
+        workers.append(asyncio.create_task(_work()))
+
+async def _work() -> None:
+    while True:
+        record = await queue.get()
+
+        try:
+            await process(record)
+        except Exception as exc:
+            print(f'[!] after request bookkeeping failed: {exc}')
+        finally:
+            queue.task_done()
+
+async def process(record: RequestRecord) -> None:
+    """Counts the input tokens (if not known yet), logs the request and updates the stats."""
+
+    if record.is_chat and record.input_tokens is None and record.messages:
+        try:
+            record.input_tokens = await tokens.count_for_messages(record.messages, record.model, record.functions)
+        except Exception as exc:
+            print(f'[!] could not count the input tokens: {exc}')
+
+    provider_auth.record_tokens(record.provider_auth, record.input_tokens)
+
+    if record.user_id:
+        await logs.log_api_request(
+            user_id=record.user_id,
+            ip_address=record.ip_address,
+            method=record.method,
+            path=record.path,
+            useragent=record.useragent,
+            target_url=record.target_url,
+            model=record.model,
+            input_tokens=record.input_tokens,
+            timings=record.timings
+        )
+
+    await stats.manager.add_date()
+    await stats.manager.add_ip_address(record.ip_address)
+    await stats.manager.add_path(record.path)
+    await stats.manager.add_target(record.target_url)
+
+    if record.is_chat:
+        await stats.manager.add_model(record.model)
+        await stats.manager.add_tokens(record.input_tokens or 0, record.model)
+
+async def drain() -> None:
+    """Waits until all queued records are processed and stops the workers, e.g. when the API shuts down."""
+
+    if not workers:
+        return
+
+    await queue.join()
+
+    for worker in workers:
+        worker.cancel()
+
+    workers.clear()
 
 async def after_request(
-    incoming_request: dict,
+    context: RequestContext,
     target_request: dict,
-    user: dict,
     credits_cost: int,
-    input_tokens: int,
-    path: str,
     is_chat: bool,
     model: str,
+    input_tokens: int=None,
 ) -> None:
-    if user and incoming_request:
-        await logs.log_api_request(user=user, incoming_request=incoming_request, target_url=target_request['url'])
-
-    if credits_cost and user:
-        await users.manager.update_by_id(user['_id'], {'$inc': {'credits': -credits_cost}})
+    """Queues the bookkeeping of a finished request.
+    Only waits if the queue is full, so a slow database slows down new requests instead of piling up records.
+    """
 
-    ip_address = await network.get_ip(incoming_request)
+    await start()
 
-    await stats.manager.add_date()
-    await stats.manager.add_ip_address(ip_address)
-    await stats.manager.add_path(path)
-    await stats.manager.add_target(target_request['url'])
+    context.mark('done')
 
-    if is_chat:
-        await stats.manager.add_model(model)
-        await stats.manager.add_tokens(input_tokens, model)
+    await queue.put(RequestRecord(
+        user_id=str(context.user['_id']) if context.user else None,
+        ip_address=context.ip_address,
+        method=context.method,
+        path=context.path,
+        useragent=context.useragent,
+        target_url=target_request['url'],
+        provider_auth=target_request.get('provider_auth'),
+        model=model,
+        is_chat=is_chat,
+        input_tokens=input_tokens,
+        messages=context.payload.get('messages'),
+        functions=context.payload.get('functions'),
+        timings=context.timings
+    ))
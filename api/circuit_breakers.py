@@ -0,0 +1,82 @@
+"""Circuit breakers, which stop sending requests to providers that keep failing."""
+
+import os
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', '30'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitBreaker:
+    """
+    ### Circuit breaker of a provider
+    - closed: requests go through. After `BREAKER_FAILURE_THRESHOLD` failures in a row, it opens.
+    - open: no requests go through, until `BREAKER_COOLDOWN` seconds have passed.
+    - half-open: a single trial request goes through. It closes on success and opens again on failure.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_started_at = None
+
+    def is_available(self) -> bool:
+        """Returns whether a request may be sent to the provider right now."""
+
+        now = time.monotonic()
+
+        if self.state == CLOSED:
+            return True
+
+        if self.state == OPEN:
+            return now - self.opened_at >= COOLDOWN
+
+        # half-open: only one trial at a time (unless the trial never reported back)
+        return self.trial_started_at is None or now - self.trial_started_at >= COOLDOWN
+
+    def on_selected(self) -> None:
+        """Must be called when a request is sent to the provider."""
+
+        if self.state != CLOSED:
+            self.state = HALF_OPEN
+            self.trial_started_at = time.monotonic()
+
+    def release(self) -> None:
+        """Must be called if a request was sent, but cancelled before it could report back."""
+
+        self.trial_started_at = None
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self.trial_started_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+
+        if self.state == HALF_OPEN or self.failures >= FAILURE_THRESHOLD:
+            if self.state != OPEN:
+                print(f'[!] circuit breaker of {self.name} opened after {self.failures} failures')
+
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.trial_started_at = None
+
+breakers = {} # module name -> CircuitBreaker
+
+def get(module_name: str) -> CircuitBreaker:
+    """Returns the circuit breaker of the provider module <module_name>."""
+
+    if module_name not in breakers:
+        breakers[module_name] = CircuitBreaker(module_name)
+
+    return breakers[module_name]
@@ -1,11 +1,11 @@
 import os
+import json
 import time
+import asyncio
 
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
 
-from helpers import network
-
 load_dotenv()
 
 UA_SIMPLIFY = {
@@ -16,6 +16,14 @@ UA_SIMPLIFY = {
     'AppleWebKit/537.36 (KHTML, like Gecko)': 'K',
 }
 
+QUEUE_SIZE = int(os.getenv('LOGS_QUEUE_SIZE', '10000'))
+BATCH_SIZE = int(os.getenv('LOGS_BATCH_SIZE', '500'))
+BATCH_INTERVAL = float(os.getenv('LOGS_BATCH_INTERVAL', '2'))
+WRITE_TIMEOUT = float(os.getenv('LOGS_WRITE_TIMEOUT', '10'))
+SPILL_FILE = os.getenv('LOGS_SPILL_FILE', 'logs.spill.jsonl')
+
+STOP = object() # queued by LogWriter.close, the writer stops once it gets it
+
 ## MONGODB Setup
 
 conn = AsyncIOMotorClient(os.environ['MONGO_URI'])
@@ -29,50 +37,161 @@ async def replacer(text: str, dict_: dict) -> str:
         text = text.replace(k, v)
     return text
 
-async def log_api_request(user: dict, incoming_request, target_url: str):
+class LogWriter:
+    """
+    ### Batched writer for log items
+    Log items are put into a bounded queue and written with unordered `insert_many` calls,
+    once `LOGS_BATCH_SIZE` items have been collected or after `LOGS_BATCH_INTERVAL` seconds.
+    If the queue is full or the database doesn't answer in time, items are appended to `LOGS_SPILL_FILE` instead.
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.batch = [] # items taken from the queue, but not written yet
+        self.stopping = False
+        self._writer = None
+        self._spills = set()
+
+    async def start(self) -> None:
+        if not self._writer:
+            self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+            self.stopping = False
+            self._writer = asyncio.create_task(self._write_forever())
+
+    def put(self, log_item: dict) -> None:
+        """Queues <log_item> without waiting. Never blocks."""
+
+        if not self._writer:
+            self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+            self.stopping = False
+            self._writer = asyncio.create_task(self._write_forever())
+
+        try:
+            self.queue.put_nowait(log_item)
+        except asyncio.QueueFull:
+            spill = asyncio.create_task(asyncio.to_thread(self.spill, [log_item]))
+            self._spills.add(spill)
+            spill.add_done_callback(self._spills.discard)
+
+    def _add(self, item) -> None:
+        if item is STOP:
+            self.stopping = True
+        else:
+            self.batch.append(item)
+
+    async def _collect_batch(self) -> None:
+        self._add(await self.queue.get())
+        deadline = time.monotonic() + BATCH_INTERVAL
+
+        while len(self.batch) < BATCH_SIZE and not self.stopping:
+            timeout = deadline - time.monotonic()
+
+            if timeout <= 0:
+                break
+
+            try:
+                self._add(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def _write_forever(self) -> None:
+        while not self.stopping:
+            await self._collect_batch()
+            batch, self.batch = self.batch, []
+
+            if batch:
+                await self.write(batch)
+
+    async def write(self, batch: list) -> None:
+        db = await _get_collection('logs')
+
+        try:
+            await asyncio.wait_for(db.insert_many(batch, ordered=False), WRITE_TIMEOUT)
+        except Exception as exc:
+            print(f'[!] could not write {len(batch)} logs, spilling them to {SPILL_FILE}: {exc}')
+            await asyncio.to_thread(self.spill, batch)
+
+    def spill(self, batch: list) -> None:
+        """Appends <batch> to the spill file. Blocks, so it's run in a thread."""
+
+        with open(SPILL_FILE, 'a', encoding='utf8') as f:
+            for log_item in batch:
+                log_item.pop('_id', None)
+                f.write(json.dumps(log_item) + '\n')
+
+    async def close(self) -> None:
+        """Stops the writer once it wrote the queued items (and the batch it may be writing right now)."""
+
+        if not self._writer:
+            return
+
+        await self.queue.put(STOP)
+        await self._writer
+        self._writer = None
+
+        # items which were queued after the writer stopped
+        batch = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+
+            if item is not STOP:
+                batch.append(item)
+
+        if batch:
+            await self.write(batch)
+
+        await asyncio.gather(*self._spills)
+
+writer = LogWriter()
+
+async def log_api_request(
+    user_id: str,
+    ip_address: str,
+    method: str,
+    path: str,
+    useragent: str,
+    target_url: str,
+    model: str=None,
+    input_tokens: int=None,
+    timings: dict=None
+):
     """Logs the API Request into the database.
     No input prompt is logged, however data such as IP & useragent is noted.
     This would be useful for security reasons. Other minor data is also collected.
+    The log item is queued and written in the background, see `LogWriter`.
 
     Args:
-        user (dict): User dict object
-        incoming_request (_type_): Request
+        user_id (str): ID of the user
+        ip_address (str): IP address of the client
+        method (str): HTTP method
+        path (str): The requested path
+        useragent (str): User agent of the client
         target_url (str): The URL the api request was targetted to.
-
-    Returns:
-        _type_: _description_
+        model (str, optional): The requested model.
+        input_tokens (int, optional): Tokens of the input, used for billing and capacity planning.
+        timings (dict, optional): Seconds after the request arrived at which its stages finished.
     """
-    db = await _get_collection('logs')
-    payload = {}
-
-    try:
-        payload = await incoming_request.json()
-    except Exception as exc:
-        if 'JSONDecodeError' in str(exc):
-            pass
 
-    model = payload.get('model')
-    ip_address = await network.get_ip(incoming_request)
-    useragent = await replacer(incoming_request.headers.get('User-Agent', ''), UA_SIMPLIFY)
+    useragent = await replacer(useragent, UA_SIMPLIFY)
 
     new_log_item = {
         'timestamp': time.time(),
-        'method': incoming_request.method,
-        'path': incoming_request.url.path,
-        'user_id': str(user['_id']),
+        'method': method,
+        'path': path,
+        'user_id': user_id,
         'security': {
             'ip': ip_address,
             'useragent': useragent,
         },
         'details': {
             'model': model,
-            'target_url': target_url
+            'input_tokens': input_tokens,
+            'target_url': target_url,
+            'timings': timings
         }
     }
 
-    inserted = await db.insert_one(new_log_item)
-    log_item = await db.find_one({'_id': inserted.inserted_id})
-    return log_item
+    writer.put(new_log_item)
 
 async def by_id(log_id: str):
     db = await _get_collection('logs')
@@ -6,12 +6,21 @@ import json
 import time
 
 from dotenv import load_dotenv
+from pymongo.errors import OperationFailure
 from motor.motor_asyncio import AsyncIOMotorClient
 
 load_dotenv()
 
 ## Statistics
 
+FLUSH_INTERVAL = float(os.getenv('STATS_FLUSH_INTERVAL', '10'))
+FLUSH_THRESHOLD = int(os.getenv('STATS_FLUSH_THRESHOLD', '1000'))
+
+def _key(value: str) -> str:
+    """Makes <value> (which may come from the client) safe to use as a single field name."""
+
+    return str(value).replace('.', '_').replace('$', '_') or '_'
+
 class StatsManager:
     """
     ### The manager for all statistics tracking
@@ -22,42 +31,128 @@ class StatsManager:
     - Tokens
     - Models
     - URL Paths
+
+    Increments are aggregated in memory and written as one combined `$inc`,
+    every `STATS_FLUSH_INTERVAL` seconds or after `STATS_FLUSH_THRESHOLD` increments.
     """
 
     def __init__(self):
         self.conn = AsyncIOMotorClient(os.environ['MONGO_URI'])
+        self.pending = {}
+        self.pending_count = 0
+        self._flusher = None
+        self._flush_task = None
+        self._stopping = asyncio.Event()
 
     async def _get_collection(self, collection_name: str):
         return self.conn[os.getenv('MONGO_NAME', 'nova-test')][collection_name]
-    
+
+    async def start(self) -> None:
+        """Starts flushing the aggregated stats regularly."""
+
+        self._start_flusher()
+
+    def _start_flusher(self) -> None:
+        if not self._flusher:
+            self._stopping.clear()
+            self._flusher = asyncio.create_task(self._flush_forever())
+
+    async def _flush_forever(self) -> None:
+        # stopped with an event instead of cancelling it, so a write in progress isn't interrupted
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                await self._try_flush()
+
+    async def _try_flush(self) -> None:
+        try:
+            await self.flush()
+        except Exception as exc:
+            print(f'[!] could not flush stats: {exc}')
+
+    async def flush(self) -> None:
+        """Writes all aggregated increments to the database at once."""
+
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, {}
+        self.pending_count = 0
+
+        db = await self._get_collection('stats')
+
+        try:
+            await db.update_one({}, {'$inc': pending}, upsert=True)
+        except OperationFailure:
+            # a single invalid field fails the whole update, so the fields are written one by one and invalid ones are dropped
+            await self._flush_fields(db, pending)
+        except BaseException: # also when cancelled
+            self._requeue(pending)
+            raise
+
+    async def _flush_fields(self, db, pending: dict) -> None:
+        fields = list(pending.items())
+
+        for position, (field, amount) in enumerate(fields):
+            try:
+                await db.update_one({}, {'$inc': {field: amount}}, upsert=True)
+            except OperationFailure as exc:
+                print(f'[!] dropped invalid stats field {field}: {exc}')
+            except BaseException:
+                self._requeue(dict(fields[position:]))
+                raise
+
+    def _requeue(self, pending: dict) -> None:
+        """Keeps increments which couldn't be written for the next flush."""
+
+        for field, amount in pending.items():
+            self.pending[field] = self.pending.get(field, 0) + amount
+
+    async def close(self) -> None:
+        """Stops the regular flushing, waits for flushes in progress and writes what's left."""
+
+        if self._flusher:
+            self._stopping.set()
+            await self._flusher
+            self._flusher = None
+
+        if self._flush_task:
+            await self._flush_task
+            self._flush_task = None
+
+        await self.flush()
+
+    def _increment(self, field: str, amount: int=1) -> None:
+        self.pending[field] = self.pending.get(field, 0) + amount
+        self.pending_count += 1
+
+        self._start_flusher()
+
+        if self.pending_count >= FLUSH_THRESHOLD and not (self._flush_task and not self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self._try_flush())
+
     async def add_date(self):
         date = datetime.datetime.now(pytz.timezone('GMT')).strftime('%Y.%m.%d')
         year, month, day = date.split('.')
 
-        db = await self._get_collection('stats')
-        await db.update_one({}, {'$inc': {f'dates.{year}.{month}.{day}': 1}}, upsert=True)
+        self._increment(f'dates.{year}.{month}.{day}')
 
     async def add_ip_address(self, ip_address: str):
-        ip_address = ip_address.replace('.', '_')
-        db = await self._get_collection('stats')
-        await db.update_one({}, {'$inc': {f'ips.{ip_address}': 1}}, upsert=True)
+        self._increment(f'ips.{_key(ip_address)}')
 
     async def add_target(self, url: str):
-        db = await self._get_collection('stats')
-        await db.update_one({}, {'$inc': {f'targets.{url}': 1}}, upsert=True)
+        self._increment(f'targets.{_key(url)}')
 
     async def add_tokens(self, tokens: int, model: str):
-        db = await self._get_collection('stats')
-        await db.update_one({}, {'$inc': {f'tokens.{model}': tokens}}, upsert=True)
+        self._increment(f'tokens.{_key(model)}', tokens)
 
     async def add_model(self, model: str):
-        db = await self._get_collection('stats')
-        await db.update_one({}, {'$inc': {f'models.{model}': 1}}, upsert=True)
+        self._increment(f'models.{_key(model)}')
 
     async def add_path(self, path: str):
         path = path.replace('/', '_')
-        db = await self._get_collection('stats')
-        await db.update_one({}, {'$inc': {f'paths.{path}': 1}}, upsert=True)
+        self._increment(f'paths.{_key(path)}')
 
     async def get_value(self, obj_filter):
         db = await self._get_collection('stats')
@@ -65,7 +160,11 @@ class StatsManager:
 
 manager = StatsManager()
 
-if __name__ == '__main__':
+async def demo():
     stats = StatsManager()
-    asyncio.run(stats.add_date())
-    asyncio.run(stats.add_path('/__demo/test'))
+    await stats.add_date()
+    await stats.add_path('/__demo/test')
+    await stats.close()
+
+if __name__ == '__main__':
+    asyncio.run(demo())
@@ -1,9 +1,13 @@
 import os
-import yaml
+import sys
+import time
 import random
 import string
 import asyncio
+import importlib.util
+import collections
 
+from pymongo import ReturnDocument
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
 
@@ -12,10 +16,134 @@ try:
 except ImportError:
     import helpers
 
+def _import_settings():
+    """Imports the API's `settings` module. If another `settings` module comes first on the path
+    (e.g. when the rewards import this module), the API's one is loaded from its file instead.
+    """
+
+    path = os.path.join(helpers.root, 'api', 'settings.py')
+
+    try:
+        spec = importlib.util.find_spec('settings')
+    except ValueError:
+        spec = None
+
+    if spec and spec.origin and os.path.exists(spec.origin) and os.path.samefile(spec.origin, path):
+        return importlib.import_module('settings')
+
+    if 'nova_api_settings' not in sys.modules:
+        spec = importlib.util.spec_from_file_location('nova_api_settings', path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['nova_api_settings'] = module
+        spec.loader.exec_module(module)
+
+    return sys.modules['nova_api_settings']
+
+settings = _import_settings()
+
 load_dotenv()
 
-with open(helpers.root + '/api/config/config.yml', encoding='utf8') as f:
-    credits_config = yaml.safe_load(f)
+## Caching
+
+# only the fields needed to authenticate and bill a request
+HOT_PATH_PROJECTION = {'api_key': 1, 'credits': 1, 'role': 1, 'status': 1, 'auth': 1}
+
+class UserCache:
+    """
+    ### Bounded LRU cache of user documents
+    Entries expire after `ttl` seconds, the least recently used ones are dropped when the cache is full.
+    Entries can be invalidated by user ID or Discord ID, no matter which key they are cached by.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (expiry, user)
+        self.index = {} # ('id' | 'discord', value) -> {keys}
+
+    @staticmethod
+    def _index_keys(user: dict) -> list:
+        return [('id', str(user.get('_id'))), ('discord', str(user.get('auth', {}).get('discord')))]
+
+    def get(self, key: str):
+        """Returns a copy of the cached user, or None if it isn't cached (anymore)."""
+
+        entry = self.entries.get(key)
+
+        if not entry:
+            return None
+
+        if entry[0] < time.monotonic():
+            self.pop(key)
+            return None
+
+        self.entries.move_to_end(key)
+        return dict(entry[1])
+
+    def set(self, key: str, user: dict) -> None:
+        self.pop(key)
+        self.entries[key] = (time.monotonic() + self.ttl, user)
+
+        for index_key in self._index_keys(user):
+            self.index.setdefault(index_key, set()).add(key)
+
+        while len(self.entries) > self.max_size:
+            self.pop(next(iter(self.entries)))
+
+    def pop(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+
+        if not entry:
+            return
+
+        for index_key in self._index_keys(entry[1]):
+            keys = self.index.get(index_key, set())
+            keys.discard(key)
+
+            if not keys:
+                self.index.pop(index_key, None)
+
+    def _users_for(self, user_id=None, discord_id=None) -> list:
+        keys = set()
+
+        if user_id is not None:
+            keys |= self.index.get(('id', str(user_id)), set())
+
+        if discord_id is not None:
+            keys |= self.index.get(('discord', str(discord_id)), set())
+
+        return list(keys)
+
+    def invalidate(self, user_id=None, discord_id=None) -> None:
+        """Drops all entries of the user with the given user ID or Discord ID."""
+
+        for key in self._users_for(user_id, discord_id):
+            self.pop(key)
+
+    def add_credits(self, user_id, amount: int) -> None:
+        """Applies a credit change to the cached entries of a user, so they don't have to be refetched."""
+
+        for key in self._users_for(user_id=user_id):
+            self.entries[key][1]['credits'] += amount
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.index.clear()
+
+api_key_cache = UserCache(
+    max_size=int(os.getenv('USER_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('USER_CACHE_TTL', '30'))
+)
+discord_id_cache = UserCache(
+    max_size=int(os.getenv('USER_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('USER_CACHE_TTL', '30'))
+)
+
+def invalidate_cached(user_id=None, discord_id=None) -> None:
+    """Drops the user from all caches."""
+
+    api_key_cache.invalidate(user_id, discord_id)
+    discord_id_cache.invalidate(user_id, discord_id)
 
 ## MONGODB Setup
 
@@ -30,6 +158,8 @@ class UserManager:
     - `user_by_discord_id(discord_id)`
     - `user_by_api_key(api_key)`
     - `update_by_id(user_id, new_obj)`
+    - `reserve_credits(user_id, amount)`
+    - `refund_credits(user_id, amount)`
     - `update_by_filter(filter_object, new_obj)`
     - `delete(user_id)`
     """
@@ -55,7 +185,7 @@ class UserManager:
 
         new_user = {
             'api_key': new_api_key,
-            'credits': credits_config['start-credits'],
+            'credits': settings.get().config['start-credits'],
             'role': '',
             'level': '',
             'status': {
@@ -71,6 +201,7 @@ class UserManager:
         db = await self._get_collection('users')
         await db.insert_one(new_user)
         user = await db.find_one({'api_key': new_api_key})
+        invalidate_cached(discord_id=str(discord_id))
         return user
 
     async def user_by_id(self, user_id: str):
@@ -78,28 +209,94 @@ class UserManager:
         return await db.find_one({'_id': user_id})
 
     async def user_by_discord_id(self, discord_id: str):
+        discord_id = str(int(discord_id))
+
+        user = discord_id_cache.get(discord_id)
+        if user:
+            return user
+
         db = await self._get_collection('users')
-        return await db.find_one({'auth.discord': str(int(discord_id))})
+        user = await db.find_one({'auth.discord': discord_id})
+
+        if user:
+            discord_id_cache.set(discord_id, user)
+            return dict(user)
+
+        return user
 
     async def user_by_api_key(self, key: str):
+        """Returns the user with the given API key. Only the fields in `HOT_PATH_PROJECTION` are fetched."""
+
+        user = api_key_cache.get(key)
+        if user:
+            return user
+
         db = await self._get_collection('users')
-        return await db.find_one({'api_key': key})
+        user = await db.find_one({'api_key': key}, HOT_PATH_PROJECTION)
+
+        if user:
+            api_key_cache.set(key, user)
+            return dict(user)
+
+        return user
 
     async def update_by_id(self, user_id: str, update):
         db = await self._get_collection('users')
-        return await db.update_one({'_id': user_id}, update)
+        result = await db.update_one({'_id': user_id}, update)
+
+        if list(update) == ['$inc'] and list(update['$inc']) == ['credits']:
+            api_key_cache.add_credits(user_id, update['$inc']['credits'])
+            discord_id_cache.add_credits(user_id, update['$inc']['credits'])
+        else:
+            invalidate_cached(user_id=user_id)
+
+        return result
+
+    async def reserve_credits(self, user_id: str, amount: int):
+        """Takes <amount> credits from the user in a single atomic operation, but only if they have enough.
+        Returns the updated user, or None if the user doesn't have enough credits.
+        """
+
+        db = await self._get_collection('users')
+        user = await db.find_one_and_update(
+            {'_id': user_id, 'credits': {'$gte': amount}},
+            {'$inc': {'credits': -amount}},
+            projection=HOT_PATH_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        )
+
+        if user:
+            api_key_cache.set(user['api_key'], user)
+            discord_id_cache.add_credits(user_id, -amount)
+            return dict(user)
+
+        return user
+
+    async def refund_credits(self, user_id: str, amount: int):
+        """Gives back credits which were reserved for a request that failed."""
+
+        return await self.update_by_id(user_id, {'$inc': {'credits': amount}})
 
     async def update_by_discord_id(self, discord_id: str, update):
         db = await self._get_collection('users')
-        return await db.update_one({'auth.discord': str(int(discord_id))}, update)
+        result = await db.update_one({'auth.discord': str(int(discord_id))}, update)
+        invalidate_cached(discord_id=str(int(discord_id)))
+        return result
 
     async def update_by_filter(self, obj_filter, update):
         db = await self._get_collection('users')
-        return await db.update_one(obj_filter, update)
+        result = await db.update_one(obj_filter, update)
+
+        # the filter could match any user
+        api_key_cache.clear()
+        discord_id_cache.clear()
+
+        return result
 
     async def delete(self, user_id: str):
         db = await self._get_collection('users')
         await db.delete_one({'_id': user_id})
+        invalidate_cached(user_id=user_id)
 
 manager = UserManager()
 
@@ -1,29 +1,30 @@
 """Does quite a few checks and prepares the incoming request for the target endpoint, so it can be streamed"""
 
 import os
-import json
-import yaml
 import time
-import orjson
 import fastapi
 
 from dotenv import load_dotenv
 
+import settings
 import responder
 import moderation
+import single_flight
+import response_cache
+import static_responses
 
 from rich import print
 from db.users import UserManager
-from helpers import tokens, errors, network
+from helpers import errors, variables
+from request_context import RequestContext, BodyTooLarge
 
 load_dotenv()
 
 users = UserManager()
-models_list = json.load(open('cache/models.json', encoding='utf8'))
-models = [model['id'] for model in models_list['data']]
 
-with open('config/config.yml', encoding='utf8') as f:
-    config = yaml.safe_load(f)
+@settings.on_reload
+def render_models(snapshot: settings.Snapshot) -> None:
+    static_responses.register('/v1/models', snapshot.models_list)
 
 moderation_debug_key_key = os.getenv('MODERATION_DEBUG_KEY')
 
@@ -35,18 +36,22 @@ async def handle(incoming_request: fastapi.Request):
     """
     path = incoming_request.url.path.replace('v1/v1', 'v1').replace('//', '/')
 
-    ip_address = await network.get_ip(incoming_request)
+    # polled constantly by SDKs, so it's answered before anything else
+    if '/models' in path:
+        return static_responses.respond(incoming_request, '/v1/models')
+
+    context = await RequestContext.create(incoming_request, path)
+    ip_address = context.ip_address
     print(f'[bold green]>{ip_address}[/bold green]')
 
-    if '/models' in path:
-        return fastapi.responses.JSONResponse(content=models_list)
+    snapshot = settings.get() # the same configuration for the whole request, even if it's reloaded meanwhile
 
     try:
-        payload = await incoming_request.json()
-    except json.decoder.JSONDecodeError:
-        payload = {}
-    except UnicodeDecodeError:
-        payload = {}
+        await context.read_body()
+    except BodyTooLarge:
+        return await errors.error(413, 'The request is too large.', 'Shorten the input and try again.')
+
+    payload = context.payload
 
     received_key = incoming_request.headers.get('Authorization')
 
@@ -59,7 +64,9 @@ async def handle(incoming_request: fastapi.Request):
         key_tags = received_key.split('#')[1]
         received_key = received_key.split('#')[0]
 
+    context.key_tags = key_tags
     user = await users.user_by_api_key(received_key.split('Bearer ')[1].strip())
+    context.mark('auth')
 
     if not user or not user['status']['active']:
         return await errors.error(418, 'Invalid or inactive NovaAI API key!', 'Create a new NovaOSS API key or reactivate your account.')
@@ -74,71 +81,55 @@ async def handle(incoming_request: fastapi.Request):
     if 'account/credits' in path:
         return fastapi.responses.JSONResponse({'credits': user['credits']})
 
-    costs = config['costs']
-    cost = costs['other']
-
-    if 'chat/completions' in path:
-        cost = costs['chat-models'].get(payload.get('model'), cost)
-
-    role = user.get('role', 'default')
-
-    try:
-        role_cost_multiplier = config['roles'][role]['bonus']
-    except KeyError:
-        role_cost_multiplier = 1
-
-    cost = round(cost * role_cost_multiplier)
+    cost = snapshot.cost(path, payload.get('model'), user.get('role', 'default'))
 
     if user['credits'] < cost:
         return await errors.error(429, 'Not enough credits.', 'Wait or earn more credits. Learn more on our website or Discord server.')
 
 
     if 'DISABLE_VARS' not in key_tags:
-        payload_with_vars = json.dumps(payload)
-
-        replace_dict = {
-            'timestamp': str(int(time.time())),
-            'date': time.strftime('%Y-%m-%d'),
-            'time': time.strftime('%H:%M:%S'),
-            'datetime': time.strftime('%Y-%m-%d %H:%M:%S'),
-            'model': payload.get('model', 'unknown'),
+        template_variables = {
+            'timestamp': lambda: int(time.time()),
+            'date': lambda: time.strftime('%Y-%m-%d'),
+            'time': lambda: time.strftime('%H:%M:%S'),
+            'datetime': lambda: time.strftime('%Y-%m-%d %H:%M:%S'),
+            'model': lambda: payload.get('model', 'unknown'),
         }
 
         if 'ALLOW_INSECURE_VARS' in key_tags:
-            replace_dict.update({
-                'my.ip': ip_address,
-                'my.id': str(user['_id']),
-                'my.role': user.get('role', 'default'),
-                'my.credits': str(user['credits']),
-                'my.discord': user.get('auth', {}).get('discord', ''),
+            template_variables.update({
+                'my.ip': lambda: ip_address,
+                'my.id': lambda: user['_id'],
+                'my.role': lambda: user.get('role', 'default'),
+                'my.credits': lambda: user['credits'],
+                'my.discord': lambda: user.get('auth', {}).get('discord', ''),
             })
 
-        for key, value in replace_dict.items():
-            payload_with_vars = payload_with_vars.replace(f'[[{key}]]', value)
-
-        payload = json.loads(payload_with_vars)
+        payload = variables.substitute(payload, template_variables)
+        context.payload = payload
 
     policy_violation = False
 
     if not (moderation_debug_key_key and moderation_debug_key_key in key_tags and 'gpt-3' in payload.get('model', '')):
         if '/moderations' not in path:
-            inp = ''
+            inputs = []
 
             if 'input' in payload or 'prompt' in payload:
                 inp = payload.get('input', payload.get('prompt', ''))
+                inputs = list(inp) if isinstance(inp, list) else [inp]
 
+            # every message is moderated on its own, so messages resent with the history are cache hits
             if isinstance(payload.get('messages'), list):
-                inp = ''
-
-                for message in payload.get('messages', []):
-                    if message.get('role') == 'user':
-                        inp += message.get('content', '') + '\n'
+                inputs = [message.get('content') for message in payload['messages'] if message.get('role') == 'user']
 
             if 'functions' in payload:
-                inp += '\n'.join([function.get('description', '') for function in payload.get('functions', [])])
+                inputs += [function.get('description', '') for function in payload.get('functions', [])]
+
+            inputs = [inp for inp in inputs if isinstance(inp, str) and len(inp) > 2 and not inp.isnumeric()]
 
-            if inp and len(inp) > 2 and not inp.isnumeric():
-                policy_violation = await moderation.is_policy_violated(inp)
+            if inputs:
+                policy_violation = await moderation.is_any_policy_violated(inputs)
+                context.mark('moderation')
 
     if policy_violation:
         return await errors.error(
@@ -153,17 +144,37 @@ async def handle(incoming_request: fastapi.Request):
 
     media_type = 'text/event-stream' if payload.get('stream', False) else 'application/json'
 
-    if (model := payload.get('model')) not in models and model is not None:
+    if (model := payload.get('model')) not in snapshot.models and model is not None:
         return await errors.error(404, 'Model not found.', 'Check the model name and try again.')
 
+    # the credits are taken right away (atomically, so parallel requests can't overdraw)
+    # and given back by the responder if the request fails
+    if cost:
+        reserved_user = await users.reserve_credits(user['_id'], cost)
+
+        if not reserved_user:
+            return await errors.error(429, 'Not enough credits.', 'Wait or earn more credits. Learn more on our website or Discord server.')
+
+        user = reserved_user
+
+    context.user = user
+
+    cache_key = None
+
+    if response_cache.is_cacheable(path, payload, key_tags):
+        cache_key = response_cache.key_for(payload)
+
+    flight_key = None
+
+    if single_flight.is_coalescable(key_tags):
+        flight_key = single_flight.key_for(path, payload)
+
     return fastapi.responses.StreamingResponse(
         content=responder.respond(
-            user=user,
-            path=path,
-            payload=payload,
+            context=context,
             credits_cost=cost,
-            input_tokens=0,
-            incoming_request=incoming_request,
+            cache_key=cache_key,
+            flight_key=flight_key,
         ),
         media_type=media_type
     )
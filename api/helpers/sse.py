@@ -0,0 +1,225 @@
+"""Incremental parsing of server-sent events (SSE), so streams can be forwarded without decoding them."""
+
+import asyncio
+
+BOUNDARIES = (b'\n\n', b'\r\n\r\n')
+
+REFRAME_AFTER = 3 # complete data lines without a blank line, before a stream is treated as single-newline framed
+
+def _is_whole_data_line(line: bytes) -> bool:
+    """Whether <line> is a `data:` line which holds a whole JSON object (or `[DONE]`) on its own,
+    unlike the lines of a legitimate multi-line event.
+    """
+
+    data = line[5:].strip()
+    return line.startswith(b'data:') and (data == b'[DONE]' or (data.startswith(b'{') and data.endswith(b'}')))
+
+class Event:
+    """
+    ### A single event
+    Keeps a view of the raw frame, the fields are only parsed when they are accessed.
+    """
+
+    __slots__ = ('raw', '_data')
+
+    def __init__(self, raw: memoryview):
+        self.raw = raw
+        self._data = None
+
+    @property
+    def data(self) -> bytes:
+        """The (joined) `data` fields of the event."""
+
+        if self._data is None:
+            lines = bytes(self.raw).splitlines()
+            self._data = b'\n'.join(line[5:].lstrip(b' ') for line in lines if line.startswith(b'data:'))
+
+        return self._data
+
+    @property
+    def is_done(self) -> bool:
+        return self.data == b'[DONE]'
+
+class SSEParser:
+    """
+    ### Incremental SSE frame parser
+    Chunks from the upstream are fed in as they arrive, and only complete events are returned,
+    so neither events nor multibyte characters are split between two chunks.
+
+    Chunks which consist of complete events are returned unchanged (the usual case).
+    Upstreams which end their events with a single newline are detected and reframed: only once
+    `REFRAME_AFTER` whole data lines arrived in more than one chunk without a blank line between them.
+    If a blank line shows up later after all, the parser goes back to normal framing.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.reframe = False
+        self.unframed_chunks = 0 # chunks fed since the last complete event
+        self.fields = bytearray() # other fields (e.g. `event:`) which belong to the next reframed data line
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Adds <chunk> and returns all events which are complete now (may be empty), ready to be forwarded."""
+
+        if not self.buffer and not self.reframe and chunk.endswith(BOUNDARIES):
+            return chunk
+
+        self.buffer += chunk
+
+        if self.reframe:
+            if not any(boundary in self.buffer for boundary in BOUNDARIES):
+                return self._reframed_lines()
+
+            # the upstream does end its events with blank lines after all
+            self.reframe = False
+            self.buffer[:0] = self.fields
+            self.fields.clear()
+
+        end = max(self.buffer.rfind(boundary) + len(boundary) if boundary in self.buffer else 0 for boundary in BOUNDARIES)
+
+        if end:
+            frames = bytes(self.buffer[:end])
+            del self.buffer[:end]
+            self.unframed_chunks = 1 if self.buffer else 0
+            return frames
+
+        self.unframed_chunks += 1
+
+        complete_lines = self.buffer[:self.buffer.rfind(b'\n') + 1].splitlines()
+        data_lines = [bytes(line) for line in complete_lines if line.startswith(b'data:')]
+
+        if self.unframed_chunks > 1 and len(data_lines) >= REFRAME_AFTER and all(map(_is_whole_data_line, data_lines)):
+            self.reframe = True
+            return self._reframed_lines()
+
+        return b''
+
+    def _reframe(self, lines: list) -> bytes:
+        frames = []
+
+        for line in lines:
+            line = bytes(line).strip()
+
+            if not line:
+                continue
+
+            if line.startswith(b'data:'):
+                frames.append(bytes(self.fields) + line + b'\n\n')
+                self.fields.clear()
+            else:
+                self.fields += line + b'\n'
+
+        return b''.join(frames)
+
+    def _reframed_lines(self) -> bytes:
+        end = self.buffer.rfind(b'\n') + 1
+
+        if not end:
+            return b''
+
+        lines = self.buffer[:end].splitlines()
+        del self.buffer[:end]
+
+        return self._reframe(lines)
+
+    def flush(self) -> bytes:
+        """Returns what's left in the buffer as a terminated event, e.g. when the upstream didn't end the last one."""
+
+        leftover = bytes(self.buffer).strip()
+        self.buffer.clear()
+
+        if self.reframe:
+            frames = self._reframe(leftover.splitlines())
+            fields, self.fields = bytes(self.fields), bytearray()
+            return frames + (fields + b'\n' if fields else b'')
+
+        if not leftover:
+            return b''
+
+        return leftover + b'\n\n'
+
+def iter_events(frames: bytes):
+    """Yields the events in <frames> (complete events, e.g. returned by `SSEParser.feed`) without copying them."""
+
+    view = memoryview(frames)
+    position = 0
+
+    while position < len(frames):
+        ends = [(frames.find(boundary, position), boundary) for boundary in BOUNDARIES]
+        ends = [(end, boundary) for end, boundary in ends if end != -1]
+
+        if not ends:
+            break
+
+        end, boundary = min(ends)
+
+        if end > position:
+            yield Event(view[position:end])
+
+        position = end + len(boundary)
+
+async def complete_events(chunks):
+    """Yields the complete events from the upstream <chunks> (an async iterator of bytes), see `SSEParser`."""
+
+    parser = SSEParser()
+
+    async for chunk in chunks:
+        frames = parser.feed(chunk)
+
+        if frames:
+            yield frames
+
+    leftover = parser.flush()
+
+    if leftover:
+        yield leftover
+
+async def coalesce(frames, window: float, max_bytes: int):
+    """Merges <frames> (complete events) which arrive within <window> seconds into one chunk,
+    so they are sent with one write. A chunk is sent early once it reaches <max_bytes>.
+    """
+
+    loop = asyncio.get_running_loop()
+    iterator = frames.__aiter__()
+
+    buffered = []
+    size = 0
+    deadline = 0
+    next_frames = None
+
+    try:
+        while True:
+            if not next_frames:
+                next_frames = asyncio.ensure_future(iterator.__anext__())
+
+            timeout = max(deadline - loop.time(), 0) if buffered else None
+            done, _ = await asyncio.wait({next_frames}, timeout=timeout)
+
+            if not done:
+                yield b''.join(buffered)
+                buffered, size = [], 0
+                continue
+
+            finished, next_frames = next_frames, None
+
+            try:
+                frame = finished.result()
+            except StopAsyncIteration:
+                break
+
+            if not buffered:
+                deadline = loop.time() + window
+
+            buffered.append(frame)
+            size += len(frame)
+
+            if size >= max_bytes:
+                yield b''.join(buffered)
+                buffered, size = [], 0
+
+        if buffered:
+            yield b''.join(buffered)
+
+    finally:
+        if next_frames:
+            next_frames.cancel()
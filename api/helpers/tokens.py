@@ -1,65 +1,86 @@
+import os
 import time
+import orjson
 import asyncio
+import hashlib
 import tiktoken
+import functools
+import collections
+import concurrent.futures
 
-async def count_for_messages(messages: list, model: str='gpt-3.5-turbo-0613') -> int:
-    """Return the number of tokens used by a list of messages
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.getenv('TOKENIZER_WORKERS', '2')))
 
-    Args:
-        messages (list): _description_
-        model (str, optional): _description_. Defaults to 'gpt-3.5-turbo-0613'.
+CACHE_SIZE = int(os.getenv('TOKENIZER_CACHE_SIZE', '10000'))
+cache = collections.OrderedDict() # digest -> token count
 
-    Raises:
-        NotImplementedError: _description_
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Returns the encoding for <model>. Encodings are only loaded once."""
 
-    Returns:
-        int: _description_
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+def get_message_format(model: str) -> tuple:
+    """Returns how many extra tokens are used per message and per name for <model>.
+    See https://github.com/openai/openai-python/blob/main/chatml.md
     """
 
-    try:
-        encoding = tiktoken.encoding_for_model(model)
+    if model == 'gpt-3.5-turbo-0301':
+        return 4, -1 # every message follows <|start|>{role/name}\n{content}<|end|>\n, if there's a name, the role is omitted
+
+    return 3, 1
+
+def _count(messages: list, model: str, functions: list=None) -> int:
+    encoding = get_encoding(model)
+    tokens_per_message, tokens_per_name = get_message_format(model)
 
-    except KeyError:
-        encoding = tiktoken.get_encoding('cl100k_base')
-
-    if model in {
-        'gpt-3.5-turbo-0613',
-        'gpt-3.5-turbo-16k-0613',
-        'gpt-4-0314',
-        'gpt-4-32k-0314',
-        'gpt-4-0613',
-        'gpt-4-32k-0613',
-    }:
-        tokens_per_message = 3
-        tokens_per_name = 1
-
-    elif model == 'gpt-3.5-turbo-0301':
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-
-    elif 'gpt-3.5-turbo' in model:
-        return count_for_messages(messages, model='gpt-3.5-turbo-0613')
-
-    elif 'gpt-4' in model:
-        return count_for_messages(messages, model='gpt-4-0613')
-
-    else:
-        raise NotImplementedError(f"""count_for_messages() is not implemented for model {model}.
-See https://github.com/openai/openai-python/blob/main/chatml.md
-for information on how messages are converted to tokens.""")
-    
     num_tokens = 0
     for message in messages:
         num_tokens += tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+            if not isinstance(value, str):
+                value = orjson.dumps(value).decode('utf8') if value else ''
+
+            num_tokens += len(encoding.encode(value, disallowed_special=()))
             if key == 'name':
                 num_tokens += tokens_per_name
 
+    if functions:
+        num_tokens += len(encoding.encode(orjson.dumps(functions).decode('utf8'), disallowed_special=()))
+
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
 
     return num_tokens
 
+async def count_for_messages(messages: list, model: str='gpt-3.5-turbo-0613', functions: list=None) -> int:
+    """Return the number of tokens used by a list of messages (and function definitions)
+    The counting is done in a thread pool, results are cached by the hash of the content.
+
+    Args:
+        messages (list): The chat messages
+        model (str, optional): The model, decides the encoding. Defaults to 'gpt-3.5-turbo-0613'.
+        functions (list, optional): Function definitions sent along with the messages.
+
+    Returns:
+        int: The number of input tokens
+    """
+
+    key = hashlib.blake2b(orjson.dumps([model, messages, functions]), digest_size=16).digest()
+
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    num_tokens = await asyncio.get_running_loop().run_in_executor(executor, _count, messages, model, functions)
+
+    cache[key] = num_tokens
+    if len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+    return num_tokens
+
 if __name__ == '__main__':
     start = time.perf_counter()
 
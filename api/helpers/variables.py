@@ -0,0 +1,40 @@
+"""Template variables (such as `[[date]]`) in the strings of request payloads."""
+
+import re
+
+PATTERN = re.compile(r'\[\[([\w.]+)\]\]')
+
+def substitute(payload, variables: dict):
+    """Replaces the variables in all strings of <payload> in one pass, and returns it. Dicts and lists are changed in place.
+    <variables> maps the names to functions returning the values. They are only called if the variable is used,
+    and at most once. Unknown variables are kept as they are.
+    """
+
+    values = {}
+
+    def replace(match: re.Match) -> str:
+        name = match.group(1)
+
+        if name not in variables:
+            return match.group(0)
+
+        if name not in values:
+            values[name] = str(variables[name]())
+
+        return values[name]
+
+    def walk(value):
+        if isinstance(value, str):
+            return PATTERN.sub(replace, value) if '[[' in value else value
+
+        if isinstance(value, dict):
+            for key, item in value.items():
+                value[key] = walk(item)
+
+        elif isinstance(value, list):
+            for index, item in enumerate(value):
+                value[index] = walk(item)
+
+        return value
+
+    return walk(payload)
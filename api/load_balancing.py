@@ -1,7 +1,117 @@
+import os
 import random
 import asyncio
+import collections
 
 import providers
+import circuit_breakers
+
+EWMA_ALPHA = float(os.getenv('BALANCING_EWMA_ALPHA', '0.2'))
+
+class ProviderStats:
+    """
+    ### Performance of a provider
+    Exponentially weighted moving averages of the time to first byte (seconds),
+    the throughput (bytes per second, streams only) and the error rate.
+    Also keeps the latest latencies of complete non-streamed responses, for percentiles.
+    """
+
+    __slots__ = ('ttfb', 'throughput', 'error_rate', 'latencies')
+
+    def __init__(self):
+        self.ttfb = None
+        self.throughput = None
+        self.error_rate = 0.0
+        self.latencies = collections.deque(maxlen=200)
+
+    @staticmethod
+    def _average(old, new):
+        return new if old is None else old * (1 - EWMA_ALPHA) + new * EWMA_ALPHA
+
+    def record(self, ttfb: float=None, throughput: float=None, error: bool=False, latency: float=None) -> None:
+        self.error_rate = self._average(self.error_rate, float(error))
+
+        if latency is not None:
+            self.latencies.append(latency)
+
+        if ttfb is not None:
+            self.ttfb = self._average(self.ttfb, ttfb)
+
+        if throughput is not None:
+            self.throughput = self._average(self.throughput, throughput)
+
+provider_stats = {} # module name -> ProviderStats
+
+def record_result(module_name: str, ttfb: float=None, throughput: float=None, error: bool=False, latency: float=None) -> None:
+    """Records how a request to a provider went, see `ProviderStats`. Also feeds the provider's circuit breaker."""
+
+    provider_stats.setdefault(module_name, ProviderStats()).record(ttfb, throughput, error, latency)
+
+    if error:
+        circuit_breakers.get(module_name).record_failure()
+    else:
+        circuit_breakers.get(module_name).record_success()
+
+def record_latency(module_name: str, latency: float) -> None:
+    """Records the latency of a request which was cancelled (e.g. it lost a hedge), as a lower bound.
+    Doesn't affect the error rate or the circuit breaker.
+    """
+
+    provider_stats.setdefault(module_name, ProviderStats()).latencies.append(latency)
+
+def latency_percentile(module_name: str, percentile: float, min_samples: int=20):
+    """Returns the <percentile> (0-100) of the provider's latencies for non-streamed responses,
+    or None if there aren't enough samples yet.
+    """
+
+    stats = provider_stats.get(module_name)
+
+    if not stats or len(stats.latencies) < min_samples:
+        return None
+
+    latencies = sorted(stats.latencies)
+    return latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+
+def _weights(module_names: list) -> list:
+    """Weights providers by their speed (relative to the average of the candidates) and reliability.
+    Providers without measurements get an average weight, so they are tried too.
+    """
+
+    stats = [provider_stats.get(name) or ProviderStats() for name in module_names]
+
+    ttfbs = [s.ttfb for s in stats if s.ttfb]
+    throughputs = [s.throughput for s in stats if s.throughput]
+
+    mean_ttfb = sum(ttfbs) / len(ttfbs) if ttfbs else None
+    mean_throughput = sum(throughputs) / len(throughputs) if throughputs else None
+
+    weights = []
+
+    for s in stats:
+        weight = max(1 - s.error_rate, 0.05)
+
+        if s.ttfb and mean_ttfb:
+            weight *= mean_ttfb / s.ttfb
+
+        if s.throughput and mean_throughput:
+            weight *= s.throughput / mean_throughput
+
+        weights.append(weight)
+
+    return weights
+
+def _choose(candidates: list):
+    # providers with an open circuit breaker are skipped, unless all of them are open
+    candidates = [provider for provider in candidates if circuit_breakers.get(module_names[provider]).is_available()] or candidates
+
+    if len(candidates) == 1:
+        provider = candidates[0]
+    else:
+        weights = _weights([module_names[provider] for provider in candidates])
+        provider = random.choices(candidates, weights=weights)[0]
+
+    # the breaker is only told (on_selected) once a request is actually sent, see the responder
+    return provider
 
 async def _get_module_name(module) -> str:
     name = module.__name__
@@ -9,27 +119,55 @@ async def _get_module_name(module) -> str:
         return name.split('.')[-1]
     return name
 
-async def balance_chat_request(payload: dict) -> dict:
-    """
-    ### Load balance the chat completion request between chat providers.
-    Providers are sorted by streaming and models. Target (provider.chat_completion) is returned
-    """
+## Provider index, built once
 
-    providers_available = []
+module_names = {} # module -> name
+chat_providers = {} # (model, stream) -> [modules]
+organic_providers = []
+moderation_providers = []
+
+def build_index() -> None:
+    """Indexes the providers by what they support, so requests don't have to scan all of them."""
+
+    module_names.clear()
+    chat_providers.clear()
+    organic_providers.clear()
+    moderation_providers.clear()
 
     for provider_module in providers.MODULES:
-        if payload['stream'] and not provider_module.STREAMING:
-            continue
+        module_names[provider_module] = provider_module.__name__.split('.')[-1]
+
+        for model in provider_module.MODELS:
+            chat_providers.setdefault((model, False), []).append(provider_module)
+
+            if provider_module.STREAMING:
+                chat_providers.setdefault((model, True), []).append(provider_module)
 
-        if payload['model'] not in provider_module.MODELS:
-            continue
+        if provider_module.ORGANIC:
+            organic_providers.append(provider_module)
 
-        providers_available.append(provider_module)
+            if provider_module.MODERATIONS:
+                moderation_providers.append(provider_module)
+
+build_index()
+
+async def balance_chat_request(payload: dict, exclude: set=None) -> dict:
+    """
+    ### Load balance the chat completion request between chat providers.
+    Candidates are looked up by model and streaming, faster and more reliable ones are preferred.
+    Providers whose module names are in <exclude> are skipped.
+    Target (provider.chat_completion) is returned
+    """
+
+    providers_available = chat_providers.get((payload['model'], bool(payload['stream'])))
+
+    if exclude:
+        providers_available = [provider for provider in providers_available or [] if module_names[provider] not in exclude]
 
     if not providers_available:
         raise ValueError(f'The model "{payload["model"]}" is not available. MODEL_UNAVAILABLE')
 
-    provider = random.choice(providers_available)
+    provider = _choose(providers_available)
     target = await provider.chat_completion(**payload)
 
     module_name = await _get_module_name(provider)
@@ -37,30 +175,31 @@ async def balance_chat_request(payload: dict) -> dict:
 
     return target
 
-async def balance_organic_request(request: dict) -> dict:
+async def balance_organic_request(request: dict, exclude: set=None) -> dict:
     """
     ### Load balance non-chat completion request
     Balances between other "organic" providers which respond in the desired format already.
-    Organic providers are used for non-chat completions, such as moderation and other paths.    
+    Organic providers are used for non-chat completions, such as moderation and other paths.
+    Providers whose module names are in <exclude> are skipped.
     """
-    providers_available = []
 
     if not request.get('headers'):
         request['headers'] = {
             'Content-Type': 'application/json'
         }
 
-    for provider_module in providers.MODULES:
-        if not provider_module.ORGANIC:
-            continue
+    if '/moderations' in request['path']:
+        providers_available = moderation_providers
+    else:
+        providers_available = organic_providers
 
-        if '/moderations' in request['path']:
-            if not provider_module.MODERATIONS:
-                continue
+    if exclude:
+        providers_available = [provider for provider in providers_available if module_names[provider] not in exclude]
 
-        providers_available.append(provider_module)
+    if not providers_available:
+        raise ValueError('No organic provider is available.')
 
-    provider = random.choice(providers_available)
+    provider = _choose(providers_available)
     target = await provider.organify(request)
 
     module_name = await _get_module_name(provider)
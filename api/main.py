@@ -14,9 +14,16 @@ from fastapi.middleware.cors import CORSMiddleware
 from slowapi import Limiter, _rate_limit_exceeded_handler
 
 from helpers import network
+from db import logs, stats
 
 import core
+import proxies
+import provider_auth
+import after_request
 import handler
+import sessions
+import settings
+import static_responses
 
 load_dotenv()
 
@@ -49,19 +56,41 @@ async def startup_event():
     # https://stackoverflow.com/a/74529009
     pydantic.json.ENCODERS_BY_TYPE[ObjectId]=str
 
+    await sessions.pool.start()
+    await proxies.pool.start()
+    await stats.manager.start()
+    await logs.writer.start()
+    await after_request.start()
+    await settings.start()
+
+@app.on_event('shutdown')
+async def shutdown_event():
+    """Runs when the API shuts down."""
+
+    await settings.close()
+    await after_request.drain()
+    await stats.manager.close()
+    await logs.writer.close()
+
+    await sessions.pool.close()
+    await proxies.pool.close()
+    await provider_auth.pool.close()
+
+static_responses.register('/', {
+    'hi': 'Welcome to the Nova API!',
+    'learn_more_here': 'https://nova-oss.com',
+    'github': 'https://github.com/novaoss/nova-api',
+    'core_api_docs_for_nova_developers': '/docs',
+    'ping': 'pong'
+})
+
 @app.get('/')
-async def root():
+async def root(request: fastapi.Request):
     """
     Returns general information about the API.
     """
 
-    return {
-        'hi': 'Welcome to the Nova API!',
-        'learn_more_here': 'https://nova-oss.com',
-        'github': 'https://github.com/novaoss/nova-api',
-        'core_api_docs_for_nova_developers': '/docs',
-        'ping': 'pong'
-    }
+    return static_responses.respond(request, '/')
 
 @app.route('/v1/{path:path}', methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH'])
 async def v1_handler(request: fastapi.Request):
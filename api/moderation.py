@@ -1,15 +1,136 @@
 """This module contains functions for checking if a message violates the moderation policy."""
 
+import os
 import time
 import difflib
 import asyncio
-import aiocache
+import hashlib
+import collections
 import profanity_check
+import concurrent.futures
 
 from typing import Union
 from Levenshtein import distance
 
-cache = aiocache.Cache(aiocache.SimpleMemoryCache)
+BATCH_WINDOW = float(os.getenv('MODERATION_BATCH_WINDOW_MS', '5')) / 1000
+BATCH_SIZE = int(os.getenv('MODERATION_BATCH_SIZE', '64'))
+WORKERS = int(os.getenv('MODERATION_WORKERS', '2'))
+
+if os.getenv('MODERATION_EXECUTOR', 'thread').lower() == 'process':
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=WORKERS)
+else:
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=WORKERS)
+
+class MicroBatcher:
+    """
+    ### Collects inputs and predicts them together
+    Inputs arriving within `window` seconds (or until `max_size` are collected) are passed to <predict>
+    in one vectorized call, which runs in the executor instead of on the event loop.
+    Every caller gets its own result back.
+    """
+
+    def __init__(self, predict, window: float, max_size: int):
+        self.predict = predict
+        self.window = window
+        self.max_size = max_size
+        self.pending = [] # (input, future)
+        self.running = set()
+        self._timer = None
+
+    async def submit(self, inp: str):
+        """Queues <inp> for the next batch and returns its prediction."""
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((inp, future))
+
+        if len(self.pending) >= self.max_size:
+            self._flush()
+        elif not self._timer:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self.pending = self.pending, []
+
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run(self, batch: list) -> None:
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                executor, self.predict, [inp for inp, _ in batch]
+            )
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+batcher = MicroBatcher(profanity_check.predict, window=BATCH_WINDOW, max_size=BATCH_SIZE)
+
+class ModerationCache:
+    """
+    ### Bounded cache of moderation results
+    Inputs are keyed by a digest of their normalized text, so no prompts are kept in memory.
+    The least recently used entries are dropped once the cache exceeds `max_bytes`.
+    """
+
+    MISS = object()
+    ENTRY_OVERHEAD = 120 # rough size of the dict entry and the objects around the key and result
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict() # digest -> result
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(text: str) -> bytes:
+        """Returns the cache key for <text>. Casing and whitespace don't matter for the model, so they're normalized."""
+
+        return hashlib.blake2b(' '.join(text.lower().split()).encode('utf8'), digest_size=16).digest()
+
+    def _entry_size(self, key: bytes, result) -> int:
+        return len(key) + len(result or '') + self.ENTRY_OVERHEAD
+
+    def get(self, key: bytes):
+        """Returns the cached result for <key>, or `ModerationCache.MISS`."""
+
+        result = self.entries.get(key, self.MISS)
+
+        if result is self.MISS:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+        return result
+
+    def set(self, key: bytes, result) -> None:
+        if key in self.entries:
+            self.size -= self._entry_size(key, self.entries.pop(key))
+
+        self.entries[key] = result
+        self.size += self._entry_size(key, result)
+
+        while self.size > self.max_bytes and self.entries:
+            old_key, old_result = self.entries.popitem(last=False)
+            self.size -= self._entry_size(old_key, old_result)
+
+cache = ModerationCache(max_bytes=int(os.getenv('MODERATION_CACHE_BYTES', str(8 * 1024 * 1024))))
 
 def input_to_text(inp: Union[str, list]) -> str:
     """Converts the input to a string."""
@@ -30,22 +151,32 @@ def input_to_text(inp: Union[str, list]) -> str:
 async def is_policy_violated(inp: Union[str, list]) -> bool:
     """Checks if the input violates the moderation policy.
     """
-    # use aio cache to cache the result
     inp = input_to_text(inp)
+    key = cache.key_for(inp)
+
+    result = cache.get(key)
+
+    if result is cache.MISS:
+        result = await is_policy_violated__own_model(inp)
+        cache.set(key, result)
+
+    return result
+
+async def is_any_policy_violated(inputs: list) -> Union[str, bool]:
+    """Checks every input (e.g. every message of a conversation) on its own.
+    Inputs which were checked before are answered by the cache, so only new ones are predicted.
+    Returns the first violation, or False.
+    """
 
-    # utilize the cache
-    if await cache.exists(inp):
-        return await cache.get(inp)
-    else:
-        await cache.set(inp, await is_policy_violated__own_model(inp))
-        return await cache.get(inp)
+    results = await asyncio.gather(*[is_policy_violated(inp) for inp in dict.fromkeys(inputs)])
+    return next((result for result in results if result), False)
 
 async def is_policy_violated__own_model(inp: Union[str, list]) -> bool:
     """Checks if the input violates the moderation policy using our own model."""
 
     inp = input_to_text(inp).lower()
 
-    if profanity_check.predict([inp])[0]:
+    if await batcher.submit(inp):
         return 'Sorry, our moderation AI has detected NSFW content in your message.'
 
     return False
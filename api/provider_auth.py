@@ -1,13 +1,21 @@
 """This module contains functions for authenticating with providers."""
 
 import os
+import time
 import asyncio
+import tempfile
+import collections
 
 from dotenv import load_dotenv
 from dhooks import Webhook, Embed
 
+import settings
+
 load_dotenv()
 
+RATE_WINDOW = 60 # seconds, limits are per minute
+PAUSE_BASE = 1 # seconds, first pause after a 429 without Retry-After, doubled while the key keeps getting rate-limited
+
 async def invalidation_webhook(provider_and_key: str) -> None:
     """Runs when a new user is created."""
 
@@ -21,12 +29,246 @@ async def invalidation_webhook(provider_and_key: str) -> None:
     embed.add_field(name='Provider', value=provider_and_key.split('>')[0])
     embed.add_field(name='Key (censored)', value=f'||{provider_and_key.split(">")[1][:10]}...||', inline=False)
 
-    dhook.send(embed=embed)
+    await asyncio.to_thread(dhook.send, embed=embed)
+
+class KeyScheduler:
+    """
+    ### Rate budgets of provider keys
+    Tracks the requests and tokens of every key in a sliding one-minute window and compares them
+    with the limits of the provider (`provider-limits` in `config.yml`, `rpm` and `tpm`).
+    Keys which got rate-limited by the provider are paused for `Retry-After`, or with an exponential backoff.
+    """
+
+    def __init__(self, limits: dict):
+        self.limits = limits # provider -> {'rpm': int, 'tpm': int}
+        self.requests = {} # (provider, key) -> deque of timestamps
+        self.tokens = {} # (provider, key) -> deque of (timestamp, tokens)
+        self.paused_until = {} # (provider, key) -> timestamp
+        self.backoff = {} # (provider, key) -> (seconds of the last pause, when it started)
+
+    @staticmethod
+    def _prune(window: collections.deque, cutoff: float, timestamp=lambda entry: entry) -> collections.deque:
+        while window and timestamp(window[0]) < cutoff:
+            window.popleft()
+
+        return window
+
+    def load(self, provider: str, key: str) -> float:
+        """Returns how much of its budget the key has used in the current window (0 = nothing, 1 = all)."""
+
+        limits = self.limits.get(provider, {})
+        cutoff = time.monotonic() - RATE_WINDOW
+        load = 0.0
+
+        if limits.get('rpm'):
+            requests = self._prune(self.requests.get((provider, key), collections.deque()), cutoff)
+            load = max(load, len(requests) / limits['rpm'])
+
+        if limits.get('tpm'):
+            tokens = self._prune(self.tokens.get((provider, key), collections.deque()), cutoff, lambda entry: entry[0])
+            load = max(load, sum(amount for _, amount in tokens) / limits['tpm'])
+
+        return load
+
+    def has_budget(self, provider: str, key: str) -> bool:
+        if self.paused_until.get((provider, key), 0) > time.monotonic():
+            return False
+
+        return self.load(provider, key) < 1
+
+    def record_request(self, provider: str, key: str) -> None:
+        self.requests.setdefault((provider, key), collections.deque()).append(time.monotonic())
+
+    def record_tokens(self, provider: str, key: str, tokens: int) -> None:
+        self.tokens.setdefault((provider, key), collections.deque()).append((time.monotonic(), tokens))
+
+    def pause(self, provider: str, key: str, seconds: float=None) -> None:
+        """Stops handing out the key for <seconds>, e.g. after a 429.
+        Without <seconds>, the pause starts short and doubles (up to the window) while the key keeps getting paused.
+        """
+
+        now = time.monotonic()
+
+        if not seconds:
+            previous, paused_at = self.backoff.get((provider, key), (0, 0))
+            seconds = min(previous * 2, RATE_WINDOW) if previous and now - paused_at < RATE_WINDOW else PAUSE_BASE
+            self.backoff[(provider, key)] = (seconds, now)
+
+        self.paused_until[(provider, key)] = now + seconds
+
+    def choose(self, provider: str, keys: list):
+        """Returns the key with the most budget left, or None if all are used up."""
+
+        available = [key for key in keys if self.has_budget(provider, key)]
+
+        if not available:
+            return None
+
+        return min(available, key=lambda key: self.load(provider, key))
+
+class KeyPool:
+    """
+    ### In-memory pool of provider keys
+    The keys of a provider are loaded from `secret/<provider>.txt` once and handed out round-robin,
+    skipping keys without budget left (see `KeyScheduler`).
+    Invalid keys are removed from the pool immediately, the files are updated in the background
+    (the key file is replaced atomically, invalid keys are appended to `secret/<provider>.invalid.txt`).
+    """
+
+    def __init__(self, scheduler: KeyScheduler, directory: str='secret'):
+        self.scheduler = scheduler
+        self.directory = directory
+        self.keys = {} # provider -> [keys]
+        self.invalid = {} # provider -> {keys}
+        self.positions = {} # provider -> index of the next key
+        self.unsaved = {} # provider -> [keys which still need to be appended to the .invalid.txt file]
+        self._savers = {} # provider -> task
+
+    def _load(self, provider: str) -> list:
+        if provider not in self.keys:
+            try:
+                with open(f'{self.directory}/{provider}.txt', encoding='utf8') as f:
+                    self.keys[provider] = [line.strip() for line in f if line.strip()]
+            except FileNotFoundError:
+                self.keys[provider] = []
+
+            self.invalid.setdefault(provider, set())
+
+        return self.keys[provider]
+
+    def get_key(self, provider: str):
+        """Returns the next valid key of <provider> with budget left, or None if there's none."""
+
+        keys = self._load(provider)
+
+        if not keys:
+            return None
+
+        # rotate first, so keys with the same load take turns
+        position = self.positions.get(provider, 0) % len(keys)
+        self.positions[provider] = position + 1
+
+        return self.scheduler.choose(provider, keys[position:] + keys[:position])
+
+    def is_invalid(self, provider: str, key: str) -> bool:
+        return key in self.invalid.get(provider, set())
+
+    def invalidate(self, provider: str, key: str) -> bool:
+        """Removes <key> from the pool and saves the change in the background.
+        Returns False if the key was already invalidated before.
+        """
+
+        keys = self._load(provider)
+
+        if key in self.invalid[provider]:
+            return False
+
+        self.invalid[provider].add(key)
+
+        if key in keys:
+            keys.remove(key)
+
+        self.unsaved.setdefault(provider, []).append(key)
+
+        if not self._savers.get(provider):
+            self._savers[provider] = asyncio.create_task(self._save(provider))
+
+        return True
+
+    async def _save(self, provider: str) -> None:
+        # keys invalidated while saving are picked up by the next iteration
+        try:
+            while self.unsaved.get(provider):
+                newly_invalid, self.unsaved[provider] = self.unsaved[provider], []
+                await asyncio.to_thread(self._write, provider, set(self.invalid[provider]), newly_invalid)
+        finally:
+            self._savers[provider] = None
+
+    def _write(self, provider: str, invalid: set, newly_invalid: list) -> None:
+        provider_file = f'{self.directory}/{provider}.txt'
+
+        # keys added to the file in the meantime are kept
+        with open(provider_file, encoding='utf8') as f_in:
+            keys = [line.strip() for line in f_in if line.strip() and line.strip() not in invalid]
+
+        # write to a temporary file first, so the key file is never left half-written
+        with tempfile.NamedTemporaryFile('w', encoding='utf8', dir=self.directory, delete=False) as f_out:
+            f_out.write(''.join(key + '\n' for key in keys))
+
+        os.replace(f_out.name, provider_file)
+
+        with open(f'{self.directory}/{provider}.invalid.txt', 'a', encoding='utf8') as f:
+            f.write(''.join(key + '\n' for key in newly_invalid))
+
+    async def close(self) -> None:
+        """Waits until all changes are saved."""
+
+        await asyncio.gather(*[saver for saver in self._savers.values() if saver])
+
+scheduler = KeyScheduler({})
+pool = KeyPool(scheduler)
+
+@settings.on_reload
+def update_limits(snapshot: settings.Snapshot) -> None:
+    scheduler.limits = snapshot.config.get('provider-limits') or {}
+
+def get_key(provider: str):
+    """Returns the next valid key of <provider> with budget left, or None if there's none."""
+
+    return pool.get_key(provider)
+
+def _split(provider_and_key: str):
+    if not provider_and_key or '>' not in provider_and_key:
+        return None, None
+
+    return provider_and_key.split('>', 1)
+
+def is_usable(provider_and_key: str) -> bool:
+    """Returns whether the key (passed as <provider_name>><key>) is valid and has budget left."""
+
+    provider, key = _split(provider_and_key)
+
+    if not provider:
+        return True
+
+    return not pool.is_invalid(provider, key) and scheduler.has_budget(provider, key)
+
+def record_request(provider_and_key: str) -> None:
+    """Counts a request sent with the key."""
+
+    provider, key = _split(provider_and_key)
+
+    if provider:
+        scheduler.record_request(provider, key)
+
+def record_tokens(provider_and_key: str, tokens: int) -> None:
+    """Counts tokens used with the key."""
+
+    provider, key = _split(provider_and_key)
+
+    if provider and tokens:
+        scheduler.record_tokens(provider, key, tokens)
+
+def rate_limited(provider_and_key: str, retry_after: str=None) -> None:
+    """Pauses the key after the provider rate-limited it."""
+
+    provider, key = _split(provider_and_key)
+
+    if not provider:
+        return
+
+    try:
+        seconds = float(retry_after) if retry_after else None
+    except ValueError:
+        seconds = None
+
+    scheduler.pause(provider, key, seconds)
 
 async def invalidate_key(provider_and_key: str) -> None:
     """
 
     Invalidates a key stored in the secret/ folder by storing it in the associated .invalid.txt file.
+    The key isn't handed out anymore right away, the files are updated in the background (see `KeyPool`).
     The schmea in which <provider_and_key> should be passed is:
     <provider_name><key>, e.g.
     closed4>cd-...
@@ -36,20 +278,14 @@ async def invalidate_key(provider_and_key: str) -> None:
     if not provider_and_key:
         return
 
-    provider = provider_and_key.split('>')[0]
-    provider_file = f'secret/{provider}.txt'
-    key = provider_and_key.split('>')[1]
-
-    with open(provider_file, encoding='utf8') as f_in:
-        text = f_in.read()
-
-    with open(provider_file, 'w', encoding='utf8') as f_out:
-        f_out.write(text.replace(key, ''))
+    provider, key = provider_and_key.split('>', 1)
 
-    with open(f'secret/{provider}.invalid.txt', 'a', encoding='utf8') as f:
-        f.write(key + '\n')
+    if pool.invalidate(provider, key):
+        await invalidation_webhook(provider_and_key)
 
-    await invalidation_webhook(provider_and_key)
+async def demo():
+    await invalidate_key('closed>demo-...')
+    await pool.close()
 
 if __name__ == '__main__':
-    asyncio.run(invalidate_key('closed>demo-...'))
+    asyncio.run(demo())
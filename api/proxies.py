@@ -1,6 +1,7 @@
 """This module makes it easy to implement proxies by providing a class.."""
 
 import os
+import time
 import socket
 import random
 import asyncio
@@ -14,6 +15,33 @@ load_dotenv()
 
 USE_PROXY_LIST = os.getenv('USE_PROXY_LIST', 'False').lower() == 'true'
 
+DNS_TTL = float(os.getenv('PROXY_DNS_TTL', '300'))
+PROBE_INTERVAL = float(os.getenv('PROXY_PROBE_INTERVAL', '60'))
+PROBE_TIMEOUT = float(os.getenv('PROXY_PROBE_TIMEOUT', '3'))
+
+## Resolves proxy hosts without blocking the event loop
+
+dns_cache = {}
+
+async def resolve_host(host: str) -> str:
+    """Returns the IP address of <host>. Results are cached for `PROXY_DNS_TTL` seconds."""
+
+    try:
+        socket.inet_aton(host)
+        return host
+    except OSError:
+        pass
+
+    cached = dns_cache.get(host)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
+    infos = await asyncio.get_running_loop().getaddrinfo(host, None, family=socket.AF_INET, type=socket.SOCK_STREAM)
+    ip_address = infos[0][4][0]
+
+    dns_cache[host] = (ip_address, time.monotonic() + DNS_TTL)
+    return ip_address
+
 class Proxy:
     """
     ### Represents a proxy. 
@@ -37,22 +65,21 @@ class Proxy:
             url = url.split('://')[1]
 
             if '@' in url:
-                username = url.split('@')[1].split(':')[0]
-                password = url.split('@')[1].split(':')[1]
+                credentials, url = url.split('@', 1)
+                username, password = credentials.split(':', 1)
 
             host_or_ip = url.split(':')[0]
-            port = url.split(':')[1]
+            port = int(url.split(':')[1])
 
         self.proxy_type = proxy_type
         self.host_or_ip = host_or_ip
-        self.ip_address = socket.gethostbyname(self.host_or_ip) # get ip address from host
+        self.ip_address = self.host_or_ip # replaced by the resolved address, see resolve()
         self.host = self.host_or_ip
         self.port = port
         self.username = username
         self.password = password
 
         self.url = f'{self.proxy_type}://{self.username}:{self.password}@{self.host}:{self.port}'
-        self.url_ip = f'{self.proxy_type}://{self.username}:{self.password}@{self.ip_address}:{self.port}'
         self.urls = {
             'http': self.url,
             'https': self.url
@@ -61,6 +88,15 @@ class Proxy:
         self.urls_httpx = {k + '://' :v for k, v in self.urls.items()}
         self.proxies = self.url
 
+    @property
+    def url_ip(self) -> str:
+        return f'{self.proxy_type}://{self.username}:{self.password}@{self.ip_address}:{self.port}'
+
+    async def resolve(self) -> None:
+        """Resolves the host of the proxy (cached), so connecting doesn't need a DNS lookup."""
+
+        self.ip_address = await resolve_host(self.host_or_ip)
+
     @property
     def connector(self):
         """
@@ -69,6 +105,14 @@ class Proxy:
         This can be used in aiohttp.ClientSession.
         """
 
+        return self.get_connector()
+
+    def get_connector(self, **kwargs):
+        """
+        ### Returns a proxy connector with custom settings
+        Keyword arguments (e.g. `limit_per_host`, `keepalive_timeout`) are passed on to the aiohttp connector.
+        """
+
         proxy_types = {
             'http': aiohttp_socks.ProxyType.HTTP,
             'https': aiohttp_socks.ProxyType.HTTP,
@@ -82,7 +126,8 @@ class Proxy:
             port=self.port,
             rdns=False, 
             username=self.username,
-            password=self.password
+            password=self.password,
+            **kwargs
         )
 
 ## Load proxies from their files
@@ -102,26 +147,107 @@ except FileNotFoundError:
 
 ## Manages the proxy list
 
-class ProxyLists:
-    def __init__(self):
-        random_proxy = random.choice(proxies_in_files)
-
-        self.get_random = Proxy(url=random_proxy)
-        self.connector = aiohttp_socks.ChainProxyConnector.from_urls(proxies_in_files)
-
-def get_proxy() -> Proxy:
+class ProxyPool:
     """
-    ### Returns a Proxy object
-    The proxy is either from the proxy list or from the environment variables.
+    ### Pool of proxies with health tracking
+    The proxies are parsed once. A background task resolves and probes them regularly,
+    dead proxies are taken out of the rotation until they respond again.
+    Proxies are handed out randomly, weighted by their measured latency and error rate.
     """
-    
-    if USE_PROXY_LIST:
-        return ProxyLists().get_random
 
-    return Proxy(
+    def __init__(self, proxies: list):
+        self.proxies = proxies
+        self.latencies = {proxy.url: PROBE_TIMEOUT for proxy in proxies}
+        self.requests = {proxy.url: 0 for proxy in proxies}
+        self.errors = {proxy.url: 0 for proxy in proxies}
+        self.dead = set()
+        self._prober = None
+
+    async def start(self) -> None:
+        """Probes all proxies once and starts probing them in the background."""
+
+        await self.probe_all()
+
+        if not self._prober:
+            self._prober = asyncio.create_task(self._probe_forever())
+
+    async def close(self) -> None:
+        if self._prober:
+            self._prober.cancel()
+            self._prober = None
+
+    async def probe(self, proxy: Proxy) -> None:
+        """Resolves <proxy> and measures how long it takes to open a connection to it."""
+
+        start = time.perf_counter()
+
+        try:
+            await proxy.resolve()
+            _, writer = await asyncio.wait_for(asyncio.open_connection(proxy.ip_address, proxy.port), PROBE_TIMEOUT)
+            writer.close()
+        except (OSError, asyncio.TimeoutError):
+            self.dead.add(proxy.url)
+            return
+
+        self.dead.discard(proxy.url)
+        self._add_latency(proxy, time.perf_counter() - start)
+
+    async def probe_all(self) -> None:
+        await asyncio.gather(*[self.probe(proxy) for proxy in self.proxies])
+
+    async def _probe_forever(self) -> None:
+        while True:
+            await asyncio.sleep(PROBE_INTERVAL)
+            await self.probe_all()
+
+    def _add_latency(self, proxy: Proxy, latency: float) -> None:
+        # exponentially weighted moving average
+        self.latencies[proxy.url] = self.latencies[proxy.url] * 0.8 + latency * 0.2
+
+    def report_success(self, proxy: Proxy, latency: float=None) -> None:
+        """Records a successful request through <proxy>."""
+
+        self.requests[proxy.url] += 1
+
+        if latency is not None:
+            self._add_latency(proxy, latency)
+
+    def report_error(self, proxy: Proxy) -> None:
+        """Records a failed request through <proxy>."""
+
+        self.requests[proxy.url] += 1
+        self.errors[proxy.url] += 1
+
+    def error_rate(self, proxy: Proxy) -> float:
+        # additive smoothing, so a single error doesn't exclude a fresh proxy
+        return (self.errors[proxy.url] + 1) / (self.requests[proxy.url] + 2)
+
+    def get(self) -> Proxy:
+        """Returns a random live proxy, faster and more reliable ones are more likely to be picked."""
+
+        alive = [proxy for proxy in self.proxies if proxy.url not in self.dead] or self.proxies
+
+        if len(alive) == 1:
+            return alive[0]
+
+        weights = [(1 - self.error_rate(proxy)) / max(self.latencies[proxy.url], 0.001) for proxy in alive]
+        return random.choices(alive, weights=weights)[0]
+
+if USE_PROXY_LIST:
+    pool = ProxyPool([Proxy(url=url) for url in proxies_in_files])
+else:
+    pool = ProxyPool([Proxy(
         proxy_type=os.getenv('PROXY_TYPE', 'http'),
         host_or_ip=os.getenv('PROXY_HOST', '127.0.0.1'),
         port=int(os.getenv('PROXY_PORT', '8080')),
         username=os.getenv('PROXY_USER'),
         password=os.getenv('PROXY_PASS')
-    )
+    )])
+
+def get_proxy() -> Proxy:
+    """
+    ### Returns a Proxy object
+    The proxy is either from the proxy list or from the environment variables.
+    """
+
+    return pool.get()
@@ -0,0 +1,75 @@
+"""Everything about an incoming request, worked out once and shared by the handler, the responder and the bookkeeping."""
+
+import os
+import time
+import orjson
+import starlette.requests
+
+from dotenv import load_dotenv
+
+from helpers import network
+
+load_dotenv()
+
+MAX_BODY_SIZE = int(os.getenv('MAX_BODY_SIZE', str(16 * 1024 * 1024))) # bytes
+
+class BodyTooLarge(Exception):
+    """The request body is larger than `MAX_BODY_SIZE`."""
+
+class RequestContext:
+    """
+    ### Context of an incoming request
+    The body is read (with a size limit) and parsed once, and the client IP is looked up once.
+    The user and key tags are filled in by the handler once the API key is checked.
+    `timings` holds the seconds since the request arrived at which its stages finished, see `mark`.
+    """
+
+    __slots__ = ('request', 'path', 'method', 'useragent', 'cookies', 'ip_address', 'body', 'payload', 'user', 'key_tags', 'started', 'timings')
+
+    def __init__(self, request: starlette.requests.Request, path: str, ip_address: str):
+        self.request = request
+        self.path = path
+        self.method = request.method
+        self.useragent = request.headers.get('User-Agent', '')
+        self.cookies = request.cookies
+        self.ip_address = ip_address
+        self.body = b''
+        self.payload = {}
+        self.user = None
+        self.key_tags = ''
+        self.started = time.perf_counter()
+        self.timings = {}
+
+    @classmethod
+    async def create(cls, request: starlette.requests.Request, path: str):
+        return cls(request, path, await network.get_ip(request))
+
+    async def read_body(self) -> None:
+        """Reads and parses the body. Raises `BodyTooLarge` as soon as it's clear the body is too large.
+        Bodies which aren't valid JSON result in an empty payload.
+        """
+
+        if int(self.request.headers.get('Content-Length') or 0) > MAX_BODY_SIZE:
+            raise BodyTooLarge
+
+        body = bytearray()
+
+        async for chunk in self.request.stream():
+            body += chunk
+
+            if len(body) > MAX_BODY_SIZE:
+                raise BodyTooLarge
+
+        self.body = bytes(body)
+
+        try:
+            self.payload = orjson.loads(self.body)
+        except orjson.JSONDecodeError:
+            self.payload = {}
+
+        self.mark('read_body')
+
+    def mark(self, stage: str) -> None:
+        """Records that <stage> finished now."""
+
+        self.timings[stage] = round(time.perf_counter() - self.started, 6)
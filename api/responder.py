@@ -1,154 +1,469 @@
 """This module contains the streaming logic for the API."""
 
 import os
-import json
-import yaml
+import time
+import orjson
 import dhooks
 import asyncio
 import aiohttp
-import starlette
 
 from rich import print
 from dotenv import load_dotenv
 
 import proxies
+import sessions
+import circuit_breakers
 import provider_auth
 import after_request
 import load_balancing
+import single_flight
+import response_cache
 
-from helpers import network, chat, errors
+from request_context import RequestContext
+
+from db import users
+from helpers import network, chat, errors, sse
 
 load_dotenv()
 
+COALESCE_MODELS = os.getenv('SSE_COALESCE_MODELS', '').split()
+COALESCE_WINDOW = float(os.getenv('SSE_COALESCE_WINDOW_MS', '20')) / 1000
+COALESCE_MAX_BYTES = int(os.getenv('SSE_COALESCE_MAX_BYTES', '16384'))
+
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', 'False').lower() == 'true'
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+
+INVALID_KEY_MARKERS = (b'invalid_api_key', b'account_deactivated')
+
+def _is_client_error(status: int) -> bool:
+    """Whether the provider rejected the request itself (e.g. the context is too long), so retrying won't help
+    and the error can be passed on. Not for errors about the key (401, 403) or rate limits (429).
+    """
+
+    return 400 <= status < 500 and status not in (401, 403, 429)
+
+def _is_invalid_key_error(response: aiohttp.ClientResponse, body: bytes) -> bool:
+    """Checks the raw body of a failed response for the errors of invalid keys, without parsing it.
+    Successful responses aren't checked, they could mention the error codes in their content.
+    """
+
+    return not response.ok and any(marker in body for marker in INVALID_KEY_MARKERS)
+
+def _upstream_body(target_request: dict) -> bytes:
+    """Returns the body of the request to the provider. JSON payloads are serialized with orjson, which is faster than aiohttp's `json=`."""
+
+    if target_request.get('payload') is None:
+        return target_request.get('data')
+
+    headers = target_request.setdefault('headers', {})
+
+    if not any(name.lower() == 'content-type' for name in headers):
+        headers['Content-Type'] = 'application/json'
+
+    return orjson.dumps(target_request['payload'])
+
+async def _balance(balance, exclude: set=None) -> dict:
+    """Calls the load balancing function <balance> (which takes the module names to exclude),
+    skipping providers whose key is invalid or out of budget (see `provider_auth`) without sending them anything.
+    If no provider has a usable key, one is chosen anyway and the provider decides.
+    """
+
+    exclude = set(exclude or ())
+    skipped = set()
+
+    while True:
+        try:
+            target_request = await balance(exclude | skipped)
+        except ValueError:
+            if not skipped:
+                raise
+
+            return await balance(exclude)
+
+        if provider_auth.is_usable(target_request.get('provider_auth')):
+            return target_request
+
+        skipped.add(target_request['module'])
+
+async def _fetch_json(target_request: dict):
+    """Sends a non-streamed request to the provider and returns the status and the raw JSON response,
+    or None if it failed in a way which is worth retrying (transport errors, invalid keys, 429, 5xx and empty responses).
+    """
+
+    proxy = proxies.get_proxy()
+    module = target_request['module']
+
+    provider_auth.record_request(target_request.get('provider_auth'))
+    circuit_breakers.get(module).on_selected()
+
+    async with sessions.pool.session(target_request['url'], proxy) as session:
+        request_start = time.perf_counter()
+
+        try:
+            async with session.request(
+                method=target_request.get('method', 'POST'),
+                url=target_request['url'],
+                data=_upstream_body(target_request),
+                headers=target_request.get('headers', {}),
+                cookies=target_request.get('cookies'),
+                ssl=False,
+                timeout=aiohttp.ClientTimeout(
+                    connect=0.3,
+                    total=float(os.getenv('TRANSFER_TIMEOUT', '500'))
+                ),
+            ) as response:
+                proxies.pool.report_success(proxy)
+                data = await response.read()
+
+        except Exception:
+            proxies.pool.report_error(proxy)
+            load_balancing.record_result(module, error=True)
+            return None
+
+    latency = time.perf_counter() - request_start
+
+    if _is_invalid_key_error(response, data):
+        print('[!] invalid api key', target_request.get('provider_auth'))
+        await provider_auth.invalidate_key(target_request.get('provider_auth'))
+        load_balancing.record_result(module, error=True)
+        return None
+
+    if response.status == 429:
+        provider_auth.rate_limited(target_request.get('provider_auth'), response.headers.get('Retry-After'))
+
+    if _is_client_error(response.status):
+        return response.status, data
+
+    if not (response.ok and data.lstrip().startswith(b'{')):
+        if response.status == 429 or response.status >= 500 or response.ok:
+            load_balancing.record_result(module, ttfb=latency, error=True)
+        return None
+
+    load_balancing.record_result(module, ttfb=latency, latency=latency)
+    return response.status, data
+
+async def _hedged_chat_request(payload: dict) -> tuple:
+    """
+    ### Hedged non-streamed chat request
+    If the chosen provider takes longer than the `HEDGE_PERCENTILE` of its usual latency,
+    the same request is sent to another provider as well. The first successful response wins,
+    the other request is cancelled. Errors of the request itself (see `_is_client_error`) end it like a response.
+    Returns the target request and the result of `_fetch_json` (None if all requests failed).
+    """
+
+    first_target = await _balance(lambda exclude: load_balancing.balance_chat_request(payload, exclude=exclude))
+    targets = {asyncio.create_task(_fetch_json(first_target)): first_target}
+    started = {target['module']: time.perf_counter() for target in targets.values()}
+
+    delay = load_balancing.latency_percentile(first_target['module'], HEDGE_PERCENTILE)
+    pending = set(targets)
+
+    if delay is not None:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+
+        if not done:
+            try:
+                second_target = await _balance(
+                    lambda exclude: load_balancing.balance_chat_request(payload, exclude=exclude),
+                    exclude={first_target['module']}
+                )
+            except ValueError:
+                pass # no other provider available, keep waiting for the first one
+            else:
+                print(f'[!] hedging slow request to {first_target["module"]} with {second_target["module"]}')
+                second = asyncio.create_task(_fetch_json(second_target))
+                targets[second] = second_target
+                started[second_target['module']] = time.perf_counter()
+                pending.add(second)
+
+        pending |= done
+
+    result = (first_target, None)
+
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                result = (targets[task], task.result())
+
+                if result[1]:
+                    return result
+    finally:
+        for task in pending:
+            task.cancel()
+
+            # the cancelled request took at least this long. Without it, only the fast requests would be sampled
+            # and the hedging threshold would keep dropping
+            module = targets[task]['module']
+            load_balancing.record_latency(module, time.perf_counter() - started[module])
+            circuit_breakers.get(module).release()
+
+    return result
+
 async def respond(
-    path: str='/v1/chat/completions',
-    user: dict=None,
-    payload: dict=None,
+    context: RequestContext,
     credits_cost: int=0,
-    input_tokens: int=0,
-    incoming_request: starlette.requests.Request=None,
+    cache_key: str=None,
+    flight_key: str=None,
+    flight: single_flight.Flight=None,
 ):
     """Stream the completions request. Sends data in chunks
     If not streaming, it sends the result in its entirety.
+    With a <cache_key> (see `response_cache`), cached responses are replayed without asking a provider.
+    With a <flight_key> (see `single_flight`), identical requests in flight share one upstream request.
     """
 
+    path = context.path
+    user = context.user
+    payload = context.payload
+    key_tags = context.key_tags
+
     is_chat = False
 
-    model = None
+    model = payload.get('model')
     is_stream = False
 
     if 'chat/completions' in path:
         is_chat = True
         model = payload['model']
 
-    json_response = {}
+    json_response = None # raw bytes, forwarded as they are
+    error_response = None # raw error of the provider about the request itself, see _is_client_error
 
     headers = {
         'Content-Type': 'application/json',
         'User-Agent': 'axios/0.21.1',
     }
 
-    for _ in range(10):
-        # Load balancing: randomly selecting a suitable provider
-        # If the request is a chat completion, then we need to load balance between chat providers
-        # If the request is an organic request, then we need to load balance between organic providers
-        try:
-            if is_chat:
-                target_request = await load_balancing.balance_chat_request(payload)
-            else:
-                
-                # In this case we are doing a organic request. "organic" means that it's not using a reverse engineered front-end, but rather ClosedAI's API directly
-                # churchless.tech is an example of an organic provider, because it redirects the request to ClosedAI.
-                target_request = await load_balancing.balance_organic_request({
-                    'method': incoming_request.method,
-                    'path': path,
-                    'payload': payload,
-                    'headers': headers,
-                    'cookies': incoming_request.cookies
-                })
-        except ValueError as exc:
-            if model in ['gpt-3.5-turbo', 'gpt-4', 'gpt-4-32k']:
-                webhook = dhooks.Webhook(os.environ['DISCORD_WEBHOOK__API_ISSUE'])
-                webhook.send(content=f'API Issue: **`{exc}`**\nhttps://i.imgflip.com/7uv122.jpg')
-                yield await errors.yield_error(500, 'Sorry, the API has no working keys anymore.', 'The admins have been messaged automatically.')
+    cached_response = await response_cache.cache.get(cache_key) if cache_key else None
+
+    if cached_response:
+        if payload.get('stream'):
+            async for chunk in response_cache.replay_stream(cached_response):
+                yield chunk
+        else:
+            yield orjson.dumps(cached_response)
+
+        print(f'[+] {path} -> {model or ""} (cached)')
+
+        await after_request.after_request(
+            context=context,
+            target_request={'url': response_cache.TARGET_URL},
+            credits_cost=credits_cost,
+            is_chat=is_chat,
+            model=model,
+        )
+        return
+
+    if flight_key:
+        flight, is_new = single_flight.join(flight_key)
+
+        if is_new:
+            flight.start(respond(
+                context=context,
+                credits_cost=credits_cost,
+                cache_key=cache_key,
+                flight=flight,
+            ))
+
+        async for chunk in flight.follow():
+            yield chunk
+
+        # the request which started the flight does its own bookkeeping
+        if is_new:
+            return
+
+        if not flight.target_url:
+            if credits_cost and user:
+                await users.manager.refund_credits(user['_id'], credits_cost)
             return
 
-        target_request['headers'].update(target_request.get('headers', {}))
+        print(f'[+] {path} -> {model or ""} (shared)')
+
+        await after_request.after_request(
+            context=context,
+            target_request={'url': flight.target_url},
+            credits_cost=credits_cost,
+            is_chat=is_chat,
+            model=model,
+        )
+        return
 
-        if target_request['method'] == 'GET' and not payload:
-            target_request['payload'] = None
+    # the reserved credits are given back unless a response was forwarded, whatever goes wrong
+    settled = False
 
-        # We haven't done any requests as of right now, everything until now was just preparation
-        # Here, we process the request
-        async with aiohttp.ClientSession(connector=proxies.get_proxy().connector) as session:
+    try:
+        for _ in range(10):
+            # Load balancing: randomly selecting a suitable provider
+            # If the request is a chat completion, then we need to load balance between chat providers
+            # If the request is an organic request, then we need to load balance between organic providers
             try:
-                async with session.request(
-                    method=target_request.get('method', 'POST'),
-                    url=target_request['url'],
-                    data=target_request.get('data'),
-                    json=target_request.get('payload'),
-                    headers=target_request.get('headers', {}),
-                    cookies=target_request.get('cookies'),
-                    ssl=False,
-                    timeout=aiohttp.ClientTimeout(
-                        connect=0.3,
-                        total=float(os.getenv('TRANSFER_TIMEOUT', '500'))
-                    ),
-                ) as response:
-                    is_stream = response.content_type == 'text/event-stream'
-
-                    if response.status == 429:
+                if is_chat and not payload['stream'] and (HEDGE_REQUESTS or 'HEDGE' in key_tags):
+                    target_request, fetched = await _hedged_chat_request(payload)
+
+                    if not fetched:
                         continue
 
-                    if response.content_type == 'application/json':
-                        data = await response.json()
+                    status, data = fetched
+
+                    if _is_client_error(status):
+                        error_response = data
+                    else:
+                        json_response = data
 
-                        if 'method_not_supported' in str(data):
-                            await errors.error(500, 'Sorry, this endpoint does not support this method.', data['error']['message'])
+                    break
 
-                        if 'invalid_api_key' in str(data) or 'account_deactivated' in str(data):
-                            print('[!] invalid api key', target_request.get('provider_auth'))
-                            await provider_auth.invalidate_key(target_request.get('provider_auth'))
+                # providers whose keys are invalid or out of budget are skipped, without using up an attempt
+                if is_chat:
+                    target_request = await _balance(lambda exclude: load_balancing.balance_chat_request(payload, exclude=exclude))
+                else:
+                
+                    # In this case we are doing a organic request. "organic" means that it's not using a reverse engineered front-end, but rather ClosedAI's API directly
+                    # churchless.tech is an example of an organic provider, because it redirects the request to ClosedAI.
+                    target_request = await _balance(lambda exclude: load_balancing.balance_organic_request({
+                        'method': context.method,
+                        'path': path,
+                        'payload': payload,
+                        'headers': dict(headers),
+                        'cookies': context.cookies
+                    }, exclude=exclude))
+            except ValueError as exc:
+                if model in ['gpt-3.5-turbo', 'gpt-4', 'gpt-4-32k']:
+                    webhook = dhooks.Webhook(os.environ['DISCORD_WEBHOOK__API_ISSUE'])
+                    webhook.send(content=f'API Issue: **`{exc}`**\nhttps://i.imgflip.com/7uv122.jpg')
+                    yield await errors.yield_error(500, 'Sorry, the API has no working keys anymore.', 'The admins have been messaged automatically.')
+                return
+
+            provider_auth.record_request(target_request.get('provider_auth'))
+            circuit_breakers.get(target_request['module']).on_selected()
+
+            target_request['headers'].update(target_request.get('headers', {}))
+
+            if target_request['method'] == 'GET' and not payload:
+                target_request['payload'] = None
+
+            # We haven't done any requests as of right now, everything until now was just preparation
+            # Here, we process the request
+            proxy = proxies.get_proxy()
+
+            async with sessions.pool.session(target_request['url'], proxy) as session:
+                request_start = time.perf_counter()
+
+                try:
+                    async with session.request(
+                        method=target_request.get('method', 'POST'),
+                        url=target_request['url'],
+                        data=_upstream_body(target_request),
+                        headers=target_request.get('headers', {}),
+                        cookies=target_request.get('cookies'),
+                        ssl=False,
+                        timeout=aiohttp.ClientTimeout(
+                            connect=0.3,
+                            total=float(os.getenv('TRANSFER_TIMEOUT', '500'))
+                        ),
+                    ) as response:
+                        ttfb = time.perf_counter() - request_start
+                        context.mark('upstream_first_byte')
+                        proxies.pool.report_success(proxy)
+                        is_stream = response.content_type == 'text/event-stream'
+
+                        if response.status == 429:
+                            provider_auth.rate_limited(target_request.get('provider_auth'), response.headers.get('Retry-After'))
+                            load_balancing.record_result(target_request['module'], ttfb=ttfb, error=True)
                             continue
 
-                        if response.ok:
-                            json_response = data
+                        if response.content_type == 'application/json':
+                            data = await response.read()
 
-                    if is_stream:
-                        try:
-                            response.raise_for_status()
-                        except Exception as exc:
-                            if 'Too Many Requests' in str(exc):
+                            if _is_invalid_key_error(response, data):
+                                print('[!] invalid api key', target_request.get('provider_auth'))
+                                await provider_auth.invalidate_key(target_request.get('provider_auth'))
+                                load_balancing.record_result(target_request['module'], error=True)
                                 continue
 
-                        async for chunk in response.content.iter_any():
-                            chunk = chunk.decode('utf8').strip()
-                            yield chunk + '\n\n'
+                            if response.ok:
+                                json_response = data
+                                load_balancing.record_result(
+                                    target_request['module'],
+                                    ttfb=ttfb,
+                                    latency=time.perf_counter() - request_start
+                                )
+                            elif _is_client_error(response.status):
+                                error_response = data
 
-                    break
+                        if is_stream:
+                            try:
+                                response.raise_for_status()
+                            except Exception as exc:
+                                if 'Too Many Requests' in str(exc):
+                                    provider_auth.rate_limited(target_request.get('provider_auth'), response.headers.get('Retry-After'))
+                                    load_balancing.record_result(target_request['module'], ttfb=ttfb, error=True)
+                                    continue
 
-            except Exception as exc:
-                continue
+                            # upstream bytes are forwarded as they are, as long as they consist of complete events
+                            chunks = sse.complete_events(response.content.iter_any())
 
-            if (not json_response) and is_chat:
-                print('[!] chat response is empty')
-                continue
-    else:
-        yield await errors.yield_error(500, 'Sorry, the provider is not responding. We\'re possibly getting rate-limited.', 'Please try again later.')
-        return
+                            if 'COALESCE' in key_tags or model in COALESCE_MODELS:
+                                chunks = sse.coalesce(chunks, window=COALESCE_WINDOW, max_bytes=COALESCE_MAX_BYTES)
+
+                            streamed_bytes = 0
+                            settled = True
+
+                            async for chunk in chunks:
+                                streamed_bytes += len(chunk)
+                                yield chunk
+
+                            load_balancing.record_result(
+                                target_request['module'],
+                                ttfb=ttfb,
+                                throughput=streamed_bytes / max(time.perf_counter() - request_start - ttfb, 0.001)
+                            )
+
+                        elif is_chat and not json_response and (response.ok or response.status >= 500):
+                            print('[!] chat response is empty')
+                            load_balancing.record_result(target_request['module'], ttfb=ttfb, error=True)
+                            continue
+
+                        break
+
+                except Exception as exc:
+                    proxies.pool.report_error(proxy)
+                    load_balancing.record_result(target_request['module'], error=True)
+                    continue
+                except (asyncio.CancelledError, GeneratorExit):
+                    # e.g. the client went away, the trial of a half-open breaker didn't tell anything
+                    circuit_breakers.get(target_request['module']).release()
+                    raise
+        else:
+            yield await errors.yield_error(500, 'Sorry, the provider is not responding. We\'re possibly getting rate-limited.', 'Please try again later.')
+            return
+
+        if (not is_stream) and json_response:
+            settled = True
+            yield json_response
+
+            if cache_key:
+                try:
+                    response_cache.cache.set(cache_key, orjson.loads(json_response))
+                except orjson.JSONDecodeError:
+                    pass
+
+        elif (not is_stream) and error_response:
+            yield error_response
+
+        print(f'[+] {path} -> {model or ""}')
+
+        if flight:
+            flight.target_url = target_request['url']
 
-    if (not is_stream) and json_response:
-        yield json.dumps(json_response)
-
-    print(f'[+] {path} -> {model or ""}')
-
-    await after_request.after_request(
-        incoming_request=incoming_request,
-        target_request=target_request,
-        user=user,
-        credits_cost=credits_cost,
-        input_tokens=input_tokens,
-        path=path,
-        is_chat=is_chat,
-        model=model,
-    )
+        await after_request.after_request(
+            context=context,
+            target_request=target_request,
+            credits_cost=credits_cost,
+            is_chat=is_chat,
+            model=model,
+        )
+    finally:
+        if not settled and credits_cost and user:
+            await users.manager.refund_credits(user['_id'], credits_cost)
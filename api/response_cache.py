@@ -0,0 +1,218 @@
+"""Cache of responses to deterministic (temperature 0) chat completions."""
+
+import os
+import time
+import orjson
+import asyncio
+import hashlib
+import collections
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ENABLED = os.getenv('RESPONSE_CACHE', 'False').lower() == 'true'
+TTL = float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+MEMORY_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1000'))
+DIRECTORY = os.getenv('RESPONSE_CACHE_DIRECTORY') # optional on-disk tier
+DISK_SIZE = int(os.getenv('RESPONSE_CACHE_DISK_SIZE', '10000'))
+
+TARGET_URL = 'cache://responses' # logged as the target of cached responses
+
+# everything which can change the response
+KEY_FIELDS = (
+    'model', 'messages', 'functions', 'function_call', 'temperature', 'top_p', 'n', 'stop',
+    'max_tokens', 'presence_penalty', 'frequency_penalty', 'logit_bias'
+)
+
+def is_cacheable(path: str, payload: dict, key_tags: str) -> bool:
+    """Only chat completions with a temperature of 0 are cached, if enabled globally or by the `CACHE` key tag."""
+
+    if 'chat/completions' not in path or 'NO_CACHE' in key_tags:
+        return False
+
+    return (ENABLED or 'CACHE' in key_tags) and payload.get('temperature') == 0
+
+def key_for(payload: dict) -> str:
+    """Returns the cache key of a request, a hash of its canonical (sorted) JSON."""
+
+    canonical = orjson.dumps({field: payload.get(field) for field in KEY_FIELDS}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(canonical).hexdigest()
+
+class ResponseCache:
+    """
+    ### Two-tier response cache
+    Responses are kept in an in-memory LRU and, if a directory is set, on disk.
+    Entries expire after `ttl` seconds. The directory is swept of expired files on the first write
+    and then every `disk_size // 10` writes, keeping at most `disk_size` of the newest files.
+    """
+
+    def __init__(self, max_size: int, ttl: float, directory: str=None, disk_size: int=10000):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_size = disk_size
+        self.entries = collections.OrderedDict() # key -> (expiry, response)
+        self.writers = set()
+        self.writes_until_sweep = 0 # sweeps leftovers of earlier runs on the first write
+        self.sweeping = False
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+    def _remember(self, key: str, expiry: float, response: dict) -> None:
+        self.entries[key] = (expiry, response)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get(self, key: str):
+        """Returns the cached response, or None."""
+
+        entry = self.entries.get(key)
+
+        if entry and entry[0] > time.time():
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        self.entries.pop(key, None)
+
+        if not self.directory:
+            return None
+
+        entry = await asyncio.to_thread(self._read, key)
+
+        if not entry:
+            return None
+
+        self._remember(key, entry['expiry'], entry['response'])
+        return entry['response']
+
+    def _read(self, key: str):
+        try:
+            with open(self._path(key), 'rb') as f:
+                entry = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return None
+
+        if entry['expiry'] < time.time():
+            self._remove(self._path(key))
+            return None
+
+        return entry
+
+    def set(self, key: str, response: dict) -> None:
+        """Caches <response>. Writing it to disk happens in the background."""
+
+        expiry = time.time() + self.ttl
+        self._remember(key, expiry, response)
+
+        if self.directory:
+            writer = asyncio.create_task(asyncio.to_thread(self._write, key, expiry, response))
+            self.writers.add(writer)
+            writer.add_done_callback(self.writers.discard)
+
+            self.writes_until_sweep -= 1
+
+            if self.writes_until_sweep <= 0 and not self.sweeping:
+                self.writes_until_sweep = max(self.disk_size // 10, 1)
+                self.sweeping = True
+
+                sweeper = asyncio.create_task(asyncio.to_thread(self._sweep))
+                self.writers.add(sweeper)
+                sweeper.add_done_callback(self.writers.discard)
+                sweeper.add_done_callback(self._swept)
+
+    def _write(self, key: str, expiry: float, response: dict) -> None:
+        temporary_path = self._path(key) + '.tmp'
+
+        with open(temporary_path, 'wb') as f:
+            f.write(orjson.dumps({'expiry': expiry, 'response': response}))
+
+        os.replace(temporary_path, self._path(key))
+
+    def _swept(self, sweeper: asyncio.Task) -> None:
+        self.sweeping = False
+
+        if not sweeper.cancelled() and sweeper.exception():
+            print(f'[!] could not sweep the response cache: {sweeper.exception()}')
+
+    def _sweep(self) -> None:
+        """Removes expired files (by modification time, which is when they were written) and the oldest ones beyond `disk_size`."""
+
+        now = time.time()
+        files = []
+
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith(('.json', '.tmp')):
+                    continue
+
+                try:
+                    modified = entry.stat().st_mtime
+                except OSError:
+                    continue
+
+                if entry.name.endswith('.tmp'): # left behind by an interrupted write
+                    expired = modified + 60 < now
+                else:
+                    expired = modified + self.ttl < now
+                    files.append((modified, entry.path))
+
+                if expired:
+                    self._remove(entry.path)
+
+        files = [file for file in files if file[0] + self.ttl >= now]
+        files.sort(reverse=True)
+
+        for _, path in files[self.disk_size:]:
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+cache = ResponseCache(max_size=MEMORY_SIZE, ttl=TTL, directory=DIRECTORY, disk_size=DISK_SIZE)
+
+def _chunk(response: dict, index: int, delta: dict, finish_reason: str=None) -> bytes:
+    chunk = {
+        'id': response.get('id'),
+        'object': 'chat.completion.chunk',
+        'created': response.get('created', 0),
+        'model': response.get('model'),
+        'choices': [
+            {
+                'index': index,
+                'delta': delta,
+                'finish_reason': finish_reason
+            }
+        ]
+    }
+
+    return b'data: ' + orjson.dumps(chunk) + b'\n\n'
+
+async def replay_stream(response: dict):
+    """Yields a cached (non-streamed) chat completion as server-sent events, like a streamed one."""
+
+    for choice in response.get('choices', []):
+        index = choice.get('index', 0)
+        message = choice.get('message', {})
+
+        yield _chunk(response, index, {'role': message.get('role', 'assistant')})
+
+        if message.get('content'):
+            yield _chunk(response, index, {'content': message['content']})
+
+        if message.get('function_call'):
+            yield _chunk(response, index, {'function_call': message['function_call']})
+
+        yield _chunk(response, index, {}, choice.get('finish_reason', 'stop'))
+
+    yield b'data: [DONE]\n\n'
@@ -0,0 +1,96 @@
+"""This module keeps long-lived upstream HTTP sessions, so connections are reused between requests."""
+
+import os
+import time
+import asyncio
+import aiohttp
+import contextlib
+
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LIMIT_PER_HOST = int(os.getenv('UPSTREAM_LIMIT_PER_HOST', '100'))
+KEEPALIVE_TIMEOUT = float(os.getenv('UPSTREAM_KEEPALIVE_TIMEOUT', '30'))
+IDLE_TIMEOUT = float(os.getenv('UPSTREAM_IDLE_TIMEOUT', '300'))
+
+class SessionPool:
+    """
+    ### Pool of reusable upstream sessions
+    Sessions are keyed by the provider host and the proxy they go through.
+    Every session owns its own connector, so DNS, TCP, TLS and proxy handshakes
+    are only paid once per keep-alive connection instead of once per request.
+    Sessions which weren't used for `UPSTREAM_IDLE_TIMEOUT` seconds are closed.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.last_used = {}
+        self.in_use = {}
+        self._evictor = None
+
+    async def start(self) -> None:
+        """Starts the background task which closes idle sessions."""
+
+        if not self._evictor:
+            self._evictor = asyncio.create_task(self._evict_idle())
+
+    @contextlib.asynccontextmanager
+    async def session(self, url: str, proxy):
+        """Yields a pooled session for the host of <url> which is connected through <proxy>."""
+
+        key = (urlparse(url).netloc, proxy.url)
+        session = self.sessions.get(key)
+
+        if not session or session.closed:
+            # sessions are shared between users, so no cookies may be kept between requests
+            session = aiohttp.ClientSession(
+                connector=proxy.get_connector(
+                    limit_per_host=LIMIT_PER_HOST,
+                    keepalive_timeout=KEEPALIVE_TIMEOUT
+                ),
+                cookie_jar=aiohttp.DummyCookieJar()
+            )
+            self.sessions[key] = session
+
+        self.in_use[key] = self.in_use.get(key, 0) + 1
+
+        try:
+            yield session
+        finally:
+            self.in_use[key] -= 1
+            self.last_used[key] = time.monotonic()
+
+    async def _evict_idle(self) -> None:
+        while True:
+            await asyncio.sleep(IDLE_TIMEOUT / 2)
+
+            now = time.monotonic()
+
+            for key, last_used in list(self.last_used.items()):
+                if self.in_use.get(key) or now - last_used < IDLE_TIMEOUT:
+                    continue
+
+                session = self.sessions.pop(key, None)
+                self.last_used.pop(key, None)
+                self.in_use.pop(key, None)
+
+                if session:
+                    await session.close()
+
+    async def close(self) -> None:
+        """Closes all sessions, e.g. when the API shuts down."""
+
+        if self._evictor:
+            self._evictor.cancel()
+            self._evictor = None
+
+        for session in self.sessions.values():
+            await session.close()
+
+        self.sessions.clear()
+        self.last_used.clear()
+        self.in_use.clear()
+
+pool = SessionPool()
@@ -0,0 +1,135 @@
+"""The configuration (`config/config.yml`) and the model list (`cache/models.json`), reloaded when the files change."""
+
+import os
+import json
+import yaml
+import asyncio
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RELOAD_INTERVAL = float(os.getenv('CONFIG_RELOAD_INTERVAL', '5'))
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'config', 'config.yml')
+MODELS_PATH = os.path.join(os.path.dirname(__file__), 'cache', 'models.json')
+
+class Snapshot:
+    """
+    ### Version of the configuration
+    Never changed after it's created, a reload creates a new one. Derived tables, such as the costs
+    per role and model, are computed once here instead of for every request.
+    """
+
+    __slots__ = ('version', 'config', 'models_list', 'models', 'chat_costs', 'other_costs')
+
+    def __init__(self, version: int, config: dict, models_list: dict):
+        self.version = version
+        self.config = config
+        self.models_list = models_list
+        self.models = frozenset(model['id'] for model in models_list['data'])
+
+        bonuses = {role: info.get('bonus', 1) for role, info in (config.get('roles') or {}).items()}
+        bonuses[None] = 1 # roles which aren't configured
+
+        costs = config['costs']
+
+        self.other_costs = {role: round(costs['other'] * bonus) for role, bonus in bonuses.items()}
+        self.chat_costs = {
+            (role, model): round(cost * bonus)
+            for role, bonus in bonuses.items()
+            for model, cost in (costs.get('chat-models') or {}).items()
+        }
+
+    def cost(self, path: str, model: str, role: str) -> int:
+        """Returns the credits a request to <path> costs a user with <role>."""
+
+        if role not in self.other_costs:
+            role = None
+
+        if 'chat/completions' in path:
+            return self.chat_costs.get((role, model), self.other_costs[role])
+
+        return self.other_costs[role]
+
+current = None
+hooks = []
+watcher = None
+
+_mtimes = None
+
+def _read_mtimes() -> tuple:
+    return os.path.getmtime(CONFIG_PATH), os.path.getmtime(MODELS_PATH)
+
+def load() -> Snapshot:
+    """Reads the files and swaps in the new snapshot, then calls the reload hooks."""
+
+    global current, _mtimes
+
+    mtimes = _read_mtimes()
+
+    with open(CONFIG_PATH, encoding='utf8') as f:
+        config = yaml.safe_load(f)
+
+    with open(MODELS_PATH, encoding='utf8') as f:
+        models_list = json.load(f)
+
+    current = Snapshot((current.version + 1) if current else 1, config, models_list)
+    _mtimes = mtimes
+
+    for hook in hooks:
+        try:
+            hook(current)
+        except Exception as exc:
+            print(f'[!] config reload hook {hook.__name__} failed: {exc}')
+
+    return current
+
+def get() -> Snapshot:
+    """Returns the current snapshot. Use the same one for a whole request, so it sees a consistent configuration."""
+
+    return current
+
+def on_reload(hook):
+    """Registers <hook>, which is called with every new snapshot, and right away with the current one."""
+
+    hooks.append(hook)
+    hook(current)
+    return hook
+
+def reload_if_changed() -> bool:
+    """Reloads if one of the files changed. Invalid files are reported and the old snapshot is kept."""
+
+    try:
+        if _read_mtimes() == _mtimes:
+            return False
+
+        snapshot = load()
+    except Exception as exc:
+        print(f'[!] could not reload the configuration: {exc}')
+        return False
+
+    print(f'[+] configuration reloaded (version {snapshot.version})')
+    return True
+
+async def _watch_forever() -> None:
+    while True:
+        await asyncio.sleep(RELOAD_INTERVAL)
+        await asyncio.to_thread(reload_if_changed)
+
+async def start() -> None:
+    """Starts watching the files for changes."""
+
+    global watcher
+
+    if RELOAD_INTERVAL > 0 and not watcher:
+        watcher = asyncio.create_task(_watch_forever())
+
+async def close() -> None:
+    global watcher
+
+    if watcher:
+        watcher.cancel()
+        watcher = None
+
+load()
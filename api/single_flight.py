@@ -0,0 +1,86 @@
+"""Single-flight requests: identical requests which are in flight at the same time share one upstream request."""
+
+import os
+import orjson
+import asyncio
+import hashlib
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ENABLED = os.getenv('COALESCE_REQUESTS', 'False').lower() == 'true'
+
+def is_coalescable(key_tags: str) -> bool:
+    return ENABLED and 'NO_SHARE' not in key_tags # not NO_COALESCE, which would contain the COALESCE tag of streams
+
+def key_for(path: str, payload: dict) -> str:
+    """Returns the key of a request, a hash of its path and canonical (sorted) payload."""
+
+    return hashlib.sha256(path.encode() + orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+class Flight:
+    """
+    ### A request in flight
+    The chunks of the response are produced once, in a task of their own (so they keep coming
+    even if the client which started it disconnects), and broadcast to every follower.
+    Followers which join late get the chunks sent so far first.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.target_url = None # set by the responder once the request succeeded
+        self.changed = asyncio.Event()
+        self.task = None
+
+    def start(self, chunks) -> None:
+        """Starts producing the async iterator <chunks>."""
+
+        self.task = asyncio.create_task(self._produce(chunks))
+
+    async def _produce(self, chunks) -> None:
+        try:
+            async for chunk in chunks:
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as exc:
+            print(f'[!] request in flight failed: {exc}')
+        finally:
+            self.done = True
+
+            if flights.get(self.key) is self:
+                del flights[self.key]
+
+            self._notify()
+
+    def _notify(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def follow(self):
+        """Yields all chunks of the response."""
+
+        position = 0
+
+        while True:
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+
+            if self.done:
+                return
+
+            await self.changed.wait()
+
+flights = {} # key -> Flight
+
+def join(key: str) -> tuple:
+    """Returns the flight of <key> and whether it is new, in which case the caller has to start it."""
+
+    if key in flights:
+        return flights[key], False
+
+    flights[key] = Flight(key)
+    return flights[key], True
@@ -0,0 +1,50 @@
+"""Read-only responses (such as the model list) which are rendered once, instead of for every request."""
+
+import gzip
+import orjson
+import hashlib
+import starlette.requests
+import starlette.responses
+
+class StaticResponse:
+    """
+    ### Pre-rendered JSON response
+    Keeps the serialized body, a gzipped copy (if it is smaller) and strong ETags for both of them.
+    """
+
+    __slots__ = ('body', 'gzipped', 'etag', 'gzip_etag')
+
+    def __init__(self, content):
+        self.body = orjson.dumps(content)
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+        self.gzip_etag = self.etag[:-1] + '-gzip"' # strong ETags are specific to each representation
+
+        gzipped = gzip.compress(self.body, compresslevel=9, mtime=0)
+        self.gzipped = gzipped if len(gzipped) < len(self.body) else None
+
+responses = {} # path -> StaticResponse
+
+def register(path: str, content) -> None:
+    """Renders <content> as the response for <path>. Also used to update it, e.g. when the content is reloaded."""
+
+    responses[path] = StaticResponse(content)
+
+def _etag_matches(etags: tuple, if_none_match: str) -> bool:
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(etag in tags or f'W/{etag}' in tags for etag in etags)
+
+def respond(incoming_request: starlette.requests.Request, path: str) -> starlette.responses.Response:
+    """Returns the pre-rendered response for <path>, or `304 Not Modified` if the client has it already."""
+
+    static = responses[path]
+    use_gzip = static.gzipped and 'gzip' in incoming_request.headers.get('Accept-Encoding', '')
+    headers = {'ETag': static.gzip_etag if use_gzip else static.etag, 'Vary': 'Accept-Encoding'}
+
+    if _etag_matches((static.etag, static.gzip_etag), incoming_request.headers.get('If-None-Match', '')):
+        return starlette.responses.Response(status_code=304, headers=headers)
+
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        return starlette.responses.Response(content=static.gzipped, headers=headers, media_type='application/json')
+
+    return starlette.responses.Response(content=static.body, headers=headers, media_type='application/json')